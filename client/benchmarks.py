@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro benchmarks of client internals. They do not need a running server.
+
+import sys, time, struct
+
+from peerdrive import connector, struct as pdstruct
+
+
+def report(name, count, unit, seconds, extra=""):
+	print "%-30s %10d %s in %7.3fs (%10.0f %s/s) %s" % (name, count, unit,
+		seconds, count / seconds, unit, extra)
+
+
+###############################################################################
+# Packet framing
+###############################################################################
+
+def _makePackets(count):
+	packets = []
+	for i in xrange(count):
+		payload = 'x' * (i % 512)
+		packets.append(struct.pack('>HLH', len(payload)+6, i, 0x51) + payload)
+	return ''.join(packets)
+
+
+def _legacyFraming(stream, chunkSize):
+	buf = ''
+	packets = 0
+	copied = 0
+	for i in xrange(0, len(stream), chunkSize):
+		buf = buf + stream[i:i+chunkSize]
+		copied += len(buf)
+		while len(buf) > 2:
+			expect = struct.unpack_from('>H', buf, 0)[0] + 2
+			if expect <= len(buf):
+				packet = buf[2:expect]
+				buf = buf[expect:]
+				copied += len(packet) + len(buf)
+				(ref, msg) = struct.unpack_from('>LH', packet, 0)
+				payload = packet[6:]
+				packets += 1
+			else:
+				break
+	return (packets, copied)
+
+
+def _readerFraming(stream, chunkSize):
+	reader = connector._PacketReader()
+	packets = 0
+	copied = 0
+	for i in xrange(0, len(stream), chunkSize):
+		reader.feed(stream[i:i+chunkSize])
+		for (ref, msg, payload) in reader.packets():
+			copied += len(payload)
+			packets += 1
+	return (packets, copied + reader.copied)
+
+
+def benchFraming(count=100000, chunkSize=0x10000):
+	stream = _makePackets(count)
+	for (name, parser) in [("framing (string)", _legacyFraming),
+	                       ("framing (_PacketReader)", _readerFraming)]:
+		start = time.time()
+		(packets, copied) = parser(stream, chunkSize)
+		report(name, packets, "packets", time.time() - start,
+			"%d bytes copied" % copied)
+
+
+###############################################################################
+# PDSD decoding
+###############################################################################
+
+class _LegacyDecoder(object):
+	# The decoder before precompiled formats and table dispatch
+	def __init__(self, store):
+		self.__store = store
+
+	def decode(self, s):
+		self._s = s
+		self._i = 0
+		return self._decodeDoc()
+
+	def _getStore(self):
+		return self.__store
+
+	def _getInt(self, code):
+		length = struct.calcsize('<'+code)
+		value = struct.unpack_from('<'+code, self._s, self._i)[0]
+		self._i += length
+		return value
+
+	def _getStr(self, length):
+		res = self._s[self._i:self._i+length]
+		self._i += length
+		return res
+
+	def _decodeDoc(self):
+		tag = self._getInt('B')
+		if tag == 0x00:
+			res = self._decodeDict()
+		elif tag == 0x10:
+			res = self._decodeList()
+		elif tag == 0x20:
+			res = self._decodeString()
+		elif tag == 0x30:
+			res = (self._getInt('B') != 0)
+		elif tag == 0x40:
+			res = connector.RevLink()
+			res._fromStruct(self)
+		elif tag == 0x41:
+			res = connector.DocLink()
+			res._fromStruct(self)
+		elif tag == 0x50:
+			res = self._getInt('f')
+		elif tag == 0x51:
+			res = self._getInt('d')
+		elif tag == 0x60:
+			res = self._getInt('B')
+		elif tag == 0x61:
+			res = self._getInt('b')
+		elif tag == 0x62:
+			res = self._getInt('H')
+		elif tag == 0x63:
+			res = self._getInt('h')
+		elif tag == 0x64:
+			res = self._getInt('L')
+		elif tag == 0x65:
+			res = self._getInt('l')
+		elif tag == 0x66:
+			res = self._getInt('Q')
+		elif tag == 0x67:
+			res = self._getInt('q')
+		else:
+			raise TypeError("Invalid tag")
+		return res
+
+	def _decodeDict(self):
+		elements = self._getInt('L')
+		d = { }
+		for i in range(elements):
+			key = self._decodeString()
+			value = self._decodeDoc()
+			d[key] = value
+		return d
+
+	def _decodeList(self):
+		elements = self._getInt('L')
+		l = []
+		for i in range(elements):
+			l.append(self._decodeDoc())
+		return l
+
+	def _decodeString(self):
+		length = self._getInt('L')
+		value = self._getStr(length).decode('utf-8')
+		return value
+
+
+def _makeFolder(count):
+	# synthetic org.peerdrive.folder data like written by struct.Folder
+	store = '\x01' * 16
+	content = []
+	for i in xrange(count):
+		doc = struct.pack('>QQ', i, i * 7919)
+		content.append({
+			'' : connector.DocLink(store, doc, False),
+			'org.peerdrive.browser' : { 'size' : i * 1000, 'expanded' : False },
+		})
+	return connector.dumpPDSD({
+		'org.peerdrive.folder' : content,
+		'org.peerdrive.annotation' : { 'title' : u'Benchmark folder' },
+	})
+
+
+def benchDecode(count=50000):
+	data = _makeFolder(count)
+	results = []
+	for (name, decoder) in [("decode (legacy)", _LegacyDecoder),
+	                        ("decode (Decoder)", connector.Decoder)]:
+		start = time.time()
+		result = decoder('\x01' * 16).decode(data)
+		report(name, count, "entries", time.time() - start,
+			"%d bytes" % len(data))
+		results.append(result)
+	if results[0] != results[1]:
+		raise AssertionError("Decoders disagree")
+
+
+###############################################################################
+# PDSD encoding
+###############################################################################
+
+class _LegacyEncoder(object):
+	# The encoder before collecting the output in a single list
+	def encode(self, o):
+		if isinstance(o, dict):
+			res = self._encodeDict(o)
+		elif isinstance(o, (list, tuple)):
+			res = self._encodeList(o)
+		elif isinstance(o, basestring):
+			if isinstance(o, str):
+				res = struct.pack('<BL', 0x20, len(o)) + o
+			else:
+				encStr = o.encode('utf-8')
+				res = struct.pack('<BL', 0x20, len(encStr)) + encStr
+		elif o is True:
+			res = struct.pack('BB', 0x30, 1)
+		elif o is False:
+			res = struct.pack('BB', 0x30, 0)
+		elif isinstance(o, (connector.RevLink, connector.DocLink)):
+			res = o._toStruct()
+		elif isinstance(o, float):
+			res = struct.pack('<Bd', 0x51, o)
+		elif isinstance(o, (int, long)):
+			res = self._encodeInt(o)
+		else:
+			raise TypeError("Invalid object: " + repr(o))
+		return res
+
+	def _encodeDict(self, d):
+		data = struct.pack('<BL', 0x00, len(d))
+		for key, value in d.iteritems():
+			if isinstance(key, unicode):
+				key = key.encode('utf-8')
+			data += struct.pack('<L', len(key)) + key + self.encode(value)
+		return data
+
+	def _encodeList(self, l):
+		data = struct.pack('<BL', 0x10, len(l))
+		for i in l:
+			data += self.encode(i)
+		return data
+
+	def _encodeInt(self, i):
+		if i < 0:
+			if i >= -128:
+				return struct.pack('<Bb', 0x61, i)
+			elif i >= -32768:
+				return struct.pack('<Bh', 0x63, i)
+			elif i >= -2147483648:
+				return struct.pack('<Bl', 0x65, i)
+			else:
+				return struct.pack('<Bq', 0x67, i)
+		else:
+			if i <= 0xff:
+				return struct.pack('<BB', 0x60, i)
+			elif i <= 0xffff:
+				return struct.pack('<BH', 0x62, i)
+			elif i <= 0xffffffff:
+				return struct.pack('<BL', 0x64, i)
+			else:
+				return struct.pack('<BQ', 0x66, i)
+
+
+def benchEncode(count=100000):
+	data = connector.loadPDSD('\x01' * 16, _makeFolder(count))
+	results = []
+	for (name, encoder) in [("encode (legacy)", _LegacyEncoder),
+	                        ("encode (Encoder)", connector.Encoder)]:
+		start = time.time()
+		result = encoder().encode(data)
+		report(name, count, "entries", time.time() - start,
+			"%d bytes" % len(result))
+		results.append(result)
+	if results[0] != results[1]:
+		raise AssertionError("Encoders disagree")
+
+
+###############################################################################
+# Lazy PDSD decoding
+###############################################################################
+
+def _makeAnnotation(i):
+	return connector.dumpPDSD({
+		'title' : u'Document %d' % i,
+		'description' : u'Lorem ipsum dolor sit amet ' * 20,
+		'tags' : [ u'tag%d' % j for j in xrange(20) ],
+		'origin' : u'/home/user/documents/file%d.txt' % i,
+		'comment' : u'Imported',
+	})
+
+
+def benchSkim(count=10000):
+	blobs = [ _makeAnnotation(i) for i in xrange(count) ]
+	for (name, lazy) in [("skim titles (decode)", False),
+	                     ("skim titles (lazy)", True)]:
+		start = time.time()
+		for blob in blobs:
+			connector.loadPDSD('\x01' * 16, blob, lazy)['title']
+		report(name, count, "blobs", time.time() - start)
+
+
+###############################################################################
+# Folder merge
+###############################################################################
+
+def _legacyMergeList(base, versions):
+	# The list merge before hashing the items
+	added   = []
+	removed = []
+	for ver in versions:
+		for item in base:
+			if item not in ver:
+				if item not in removed:
+					removed.append(item)
+		for item in ver:
+			if item not in base:
+				if item not in added:
+					added.append(item)
+	newList = base[:]
+	for item in removed:
+		newList.remove(item)
+	for item in added:
+		newList.append(item)
+	return (newList, False)
+
+
+def _makeMerge(count):
+	# two versions of a folder, each removing and adding some entries
+	base = connector.loadPDSD('\x01' * 16, _makeFolder(count))['org.peerdrive.folder']
+	extra = connector.loadPDSD('\x01' * 16, _makeFolder(count + count/5))['org.peerdrive.folder']
+	ver1 = [ item for (i, item) in enumerate(base) if i % 10 != 3 ]
+	ver1.extend(extra[count:count+count/10])
+	ver2 = [ item for (i, item) in enumerate(base) if i % 7 != 5 ]
+	ver2.extend(extra[count+count/20:])
+	return (base, [ver1, ver2])
+
+
+def benchMerge(count=50000, legacyCount=2000):
+	(base, versions) = _makeMerge(legacyCount)
+	start = time.time()
+	legacy = _legacyMergeList(base, versions)
+	report("merge (legacy)", legacyCount, "entries", time.time() - start)
+	if pdstruct.merge(base, versions) != legacy:
+		raise AssertionError("Merges disagree")
+
+	(base, versions) = _makeMerge(count)
+	start = time.time()
+	(result, conflict) = pdstruct.merge(base, versions)
+	report("merge (struct.merge)", count, "entries", time.time() - start,
+		"%d entries merged" % len(result))
+
+
+###############################################################################
+# Main
+###############################################################################
+
+BENCHMARKS = {
+	'framing' : benchFraming,
+	'decode' : benchDecode,
+	'encode' : benchEncode,
+	'skim' : benchSkim,
+	'merge' : benchMerge,
+}
+
+if __name__ == '__main__':
+	selected = sys.argv[1:] or sorted(BENCHMARKS.keys())
+	for name in selected:
+		BENCHMARKS[name]()
@@ -18,20 +18,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys, json
-from PyQt4 import QtGui
-
-# create a QApplication; QImage needs it
-app = QtGui.QApplication(sys.argv)
-
-image = QtGui.QImage()
-image.load(sys.argv[1].decode('utf8'))
-
-data = {
-	"public.image" : {
-		"width"  : image.width(),
-		"height" : image.height()
-	}
-}
-
-print json.dumps(data)
+from peerdrive import extractors
 
+print json.dumps(extractors.image(sys.argv[1].decode('utf8')))
@@ -43,8 +43,15 @@ if len(sys.argv) < 3:
 importPath = sys.argv[1]
 
 # let's do it
+errors = []
 if len(sys.argv) > 3:
-	importFileByPath(importPath, sys.argv[2:], progress=progress, error=error)
+	importFileByPath(importPath, sys.argv[2:], progress=progress, error=error,
+		errors=errors)
 else:
-	importFileByPath(importPath, sys.argv[2])
+	importFileByPath(importPath, sys.argv[2], errors=errors)
+
+for (fileName, e) in errors:
+	print "Could not import '%s': %s" % (fileName, e)
+if errors:
+	sys.exit(1)
 
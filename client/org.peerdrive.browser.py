@@ -21,7 +21,7 @@ from PyQt4 import QtCore, QtGui#, QtOpenGL
 from datetime import datetime
 import itertools, optparse, copy, pickle, os.path
 
-from peerdrive import Connector, Registry, connector, settingsPath
+from peerdrive import Connector, Registry, connector, settingsPath, enableDiskCache
 from peerdrive.gui import utils
 from peerdrive.gui.widgets import DocumentView, DocButton
 
@@ -843,6 +843,7 @@ if __name__ == '__main__':
 	import sys
 
 	app = QtGui.QApplication(sys.argv)
+	enableDiskCache()
 	mainWin = BrowserWindow()
 	mainWin.open(sys.argv)
 	mainWin.show()
@@ -39,9 +39,11 @@ class ImageWidget(widgets.DocumentView):
 		self.setCentralWidget(self.scrollArea)
 
 	def docRead(self, readWrite, r):
-		data = r.readAll('_')
+		data = QtCore.QByteArray()
+		for chunk in r.iterRead('_'):
+			data.append(chunk)
 		image = QtGui.QImage()
-		image.loadFromData(QtCore.QByteArray(data))
+		image.loadFromData(data)
 		if image.isNull():
 			return
 		self.imageLabel.setPixmap(QtGui.QPixmap.fromImage(image))
@@ -20,7 +20,7 @@
 import sys, itertools, os, os.path
 from PyQt4 import QtCore, QtGui
 
-from peerdrive import struct, Registry
+from peerdrive import struct, Registry, enableDiskCache
 from peerdrive.connector import Connector, Watch, DocLink, RevLink
 from peerdrive.gui.widgets import DocButton, RevButton
 from peerdrive.gui.utils import showDocument, showProperties
@@ -583,6 +583,7 @@ if basePath:
 
 app = QtGui.QApplication(sys.argv)
 app.setQuitOnLastWindowClosed(False)
+enableDiskCache()
 dialog = Launchbox()
 sys.exit(app.exec_())
 
@@ -33,3 +33,10 @@ def settingsPath():
 				break
 	return _settingsPath
 
+def enableDiskCache():
+	"""Keep revision meta data across processes in a file below settingsPath()."""
+	path = settingsPath()
+	if path:
+		if not os.path.exists(path):
+			os.makedirs(path)
+		Connector().cache.attach(os.path.join(path, 'revcache.sqlite'))
@@ -18,9 +18,18 @@
 
 from __future__ import absolute_import
 
-from PyQt4 import QtCore, QtNetwork
 from datetime import datetime
-import sys, struct, atexit, weakref, traceback, os, os.path, json, time
+import sys, struct, atexit, weakref, traceback, os, os.path, json, time, collections
+import sqlite3, socket, select, errno, itertools
+
+# Qt is optional. Without it the connector talks to the server through a
+# plain socket and indications are only dispatched by process().
+try:
+	from PyQt4 import QtCore, QtNetwork
+	_QObject = QtCore.QObject
+except ImportError:
+	QtCore = QtNetwork = None
+	_QObject = object
 from . import peerdrive_client_pb2 as pb
 
 if sys.platform == "win32":
@@ -231,7 +240,373 @@ def _raiseError(error):
 		raise IOError('Unknown error')
 
 
-class _Connector(QtCore.QObject):
+class _PacketReader(object):
+	"""Splits the received byte stream into packets.
+
+	Received data is appended to a single buffer and consumed by advancing a
+	read offset. The consumed head is only discarded when it makes up at least
+	half of the buffer, so the remaining tail is moved at most once per
+	buffer generation instead of once per packet.
+	"""
+	__slots__ = ['__buf', '__pos', 'copied']
+
+	def __init__(self):
+		self.__buf = bytearray()
+		self.__pos = 0
+		self.copied = 0 # number of bytes moved for compaction
+
+	def feed(self, data):
+		buf = self.__buf
+		pos = self.__pos
+		if pos and (pos << 1) >= len(buf):
+			self.copied += len(buf) - pos
+			del buf[:pos]
+			self.__pos = 0
+		buf.extend(data)
+
+	def packets(self):
+		"""Yield (ref, msg, payload) of all complete packets received so far.
+
+		The state is re-read for every packet because the consumer may feed
+		more data or consume packets recursively while handling one.
+		"""
+		while True:
+			buf = self.__buf
+			pos = self.__pos
+			end = len(buf)
+			if end - pos < 2:
+				break
+			expect = pos + 2 + struct.unpack_from('>H', buf, pos)[0]
+			if expect > end:
+				break
+			(ref, msg) = struct.unpack_from('>LH', buf, pos+2)
+			payload = memoryview(buf)[pos+8:expect].tobytes()
+			self.__pos = expect
+			yield (ref, msg, payload)
+
+	def pending(self):
+		return len(self.__buf) - self.__pos
+
+
+class _RevCache(object):
+	"""Bounded LRU cache of revision data.
+
+	Revisions are immutable, so cached stat results, PDSD data and small
+	parts never become stale. The only thing that can change is where a
+	revision is available. Each entry therefore remembers the stores in which
+	the server has confirmed the revision in this process. Nothing is
+	answered from the cache before that. A store is dropped from the entries
+	when it reports that something disappeared.
+
+	Stat results and PDSD data may additionally be kept in a _DiskCache which
+	is consulted on misses of confirmed revisions. See attach().
+	"""
+	MAX_BLOB = 0x10000 # largest part that will be cached
+	STAT_SIZE = 256 # estimated size of a Stat object
+
+	def __init__(self, maxSize):
+		self.__revs = collections.OrderedDict() # rev -> [stores, size, values]
+		self.__size = 0
+		self.__disk = None
+		self.maxSize = maxSize
+		self.hits = 0
+		self.misses = 0
+
+	def attach(self, path):
+		if self.__disk is None:
+			try:
+				self.__disk = _DiskCache(path)
+			except sqlite3.Error:
+				pass
+
+	def flush(self):
+		if self.__disk:
+			self.__disk.flush()
+
+	def size(self):
+		return self.__size
+
+	def knows(self, rev, store):
+		entry = self.__revs.get(rev)
+		return (entry is not None) and (store in entry[0])
+
+	def lookup(self, rev, stores, key):
+		entry = self.__revs.get(rev)
+		if (entry is None) or (not entry[0]) or (stores and
+				entry[0].isdisjoint(stores)):
+			self.misses += 1
+			return None
+		if key in entry[2]:
+			self.hits += 1
+			del self.__revs[rev]
+			self.__revs[rev] = entry
+			return entry[2][key]
+		if self.__disk and (key == 'stat' or key[0] == 'data'):
+			raw = self.__disk.lookup(rev, key)
+			if raw is not None:
+				self.hits += 1
+				if key == 'stat':
+					value = Stat(pb.StatCnf.FromString(raw))
+					size = _RevCache.STAT_SIZE
+				else:
+					value = raw
+					size = len(raw)
+				self.__insert(rev, stores, key, value, size)
+				return value
+		self.misses += 1
+		return None
+
+	def confirm(self, rev, stores):
+		self.insert(rev, stores, None, None, 0)
+
+	def insert(self, rev, stores, key, value, size, raw=None):
+		self.__insert(rev, stores, key, value, size)
+		if self.__disk:
+			self.__disk.insert(rev, key, raw)
+
+	def __insert(self, rev, stores, key, value, size):
+		entry = self.__revs.pop(rev, None)
+		if entry is None:
+			entry = [set(), 0, {}]
+		entry[0].update(stores or [None])
+		if (key is not None) and (key not in entry[2]):
+			entry[2][key] = value
+			entry[1] += size
+			self.__size += size
+		self.__revs[rev] = entry
+		while (self.__size > self.maxSize) and (len(self.__revs) > 1):
+			(oldRev, oldEntry) = self.__revs.popitem(False)
+			self.__size -= oldEntry[1]
+
+	def forgetRev(self, rev, store):
+		entry = self.__revs.get(rev)
+		if entry is not None:
+			entry[0].discard(store)
+			entry[0].discard(None)
+
+	def forgetStore(self, store):
+		# The revisions of a vanished document are not known, so the store has
+		# to be confirmed again for all of them. The cached values are kept.
+		# Entries whose store is unknown (None) might be affected too.
+		for entry in self.__revs.itervalues():
+			entry[0].discard(store)
+			entry[0].discard(None)
+
+	def clear(self):
+		self.__revs.clear()
+		self.__size = 0
+
+
+class _DiskCache(object):
+	"""Persistent revision cache in an SQLite database.
+
+	The database is shared by all client processes of a user. It only holds
+	the immutable data of revisions, never where they are available, so it
+	does not need to be invalidated. The least recently used rows are
+	evicted when the database grows beyond MAX_SIZE bytes. Writes are
+	collected and committed in batches. Being a cache, all database errors
+	(e.g. a database locked by another process) are silently ignored.
+	"""
+	COMMIT_INTERVAL = 64
+	MAX_SIZE = 0x4000000
+
+	def __init__(self, path):
+		self.__db = sqlite3.connect(path, timeout=1)
+		try:
+			self.__db.execute('PRAGMA journal_mode=WAL')
+		except sqlite3.Error:
+			pass
+		with self.__db:
+			self.__db.execute('CREATE TABLE IF NOT EXISTS data (rev BLOB, '
+				'key TEXT, value BLOB, used INTEGER, PRIMARY KEY (rev, key))')
+			self.__db.execute('CREATE INDEX IF NOT EXISTS data_used ON data (used)')
+			self.__db.execute('DROP TABLE IF EXISTS revs')
+			self.__db.execute('DROP TABLE IF EXISTS stores')
+		self.__size = self.__db.execute('SELECT TOTAL(LENGTH(value)) FROM '
+			'data').fetchone()[0]
+		self.__clock = self.__db.execute('SELECT MAX(used) FROM '
+			'data').fetchone()[0] or 0
+		self.__rows = []
+		self.__used = []
+
+	def lookup(self, rev, key):
+		try:
+			row = self.__db.execute('SELECT value FROM data WHERE rev=? AND '
+				'key=?', (buffer(rev), _DiskCache.__key(key))).fetchone()
+		except sqlite3.Error:
+			return None
+		if row is None:
+			return None
+		self.__used.append((self.__tick(), buffer(rev), _DiskCache.__key(key)))
+		return str(row[0])
+
+	def insert(self, rev, key, raw):
+		if (key is None) or (raw is None):
+			return
+		self.__rows.append((buffer(rev), _DiskCache.__key(key), buffer(raw),
+			self.__tick()))
+		self.__size += len(raw)
+		if len(self.__rows) + len(self.__used) >= _DiskCache.COMMIT_INTERVAL:
+			self.flush()
+
+	def flush(self):
+		if self.__rows or self.__used:
+			try:
+				with self.__db:
+					self.__db.executemany('INSERT OR REPLACE INTO data VALUES '
+						'(?, ?, ?, ?)', self.__rows)
+					self.__db.executemany('UPDATE data SET used=? WHERE rev=? '
+						'AND key=?', self.__used)
+					if self.__size > _DiskCache.MAX_SIZE:
+						self.__evict()
+			except sqlite3.Error:
+				pass
+			self.__rows = []
+			self.__used = []
+
+	def __evict(self):
+		# drop the least recently used rows until a quarter is free again
+		limit = _DiskCache.MAX_SIZE * 3 / 4
+		self.__size = self.__db.execute('SELECT TOTAL(LENGTH(value)) FROM '
+			'data').fetchone()[0]
+		while self.__size > limit:
+			rows = self.__db.execute('SELECT rowid, LENGTH(value) FROM data '
+				'ORDER BY used LIMIT 256').fetchall()
+			if not rows:
+				break
+			self.__db.executemany('DELETE FROM data WHERE rowid=?',
+				[ (rowid,) for (rowid, size) in rows ])
+			self.__size -= sum(size for (rowid, size) in rows)
+
+	def __tick(self):
+		self.__clock += 1
+		return self.__clock
+
+	@staticmethod
+	def __key(key):
+		if key == 'stat':
+			return key
+		else:
+			return ':'.join(key)
+
+
+class _QtTransport(object):
+	def __init__(self, host, port, readyRead):
+		self.socket = QtNetwork.QTcpSocket()
+		self.socket.readyRead.connect(readyRead)
+		self.socket.connectToHost(host, port)
+		if not self.socket.waitForConnected(1000):
+			raise IOError("Could not connect to server!")
+		self.socket.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+
+	def write(self, data):
+		if self.socket.write(data) == -1:
+			raise IOError("Could not send request to server: "
+				+ str(self.socket.errorString()))
+
+	def read(self):
+		return str(self.socket.readAll())
+
+	def wait(self, timeout):
+		return self.socket.waitForReadyRead(timeout)
+
+	def errorString(self):
+		return str(self.socket.errorString())
+
+	def flush(self):
+		while self.socket.flush():
+			self.socket.waitForBytesWritten(10000)
+
+	def close(self):
+		self.socket.disconnectFromHost()
+
+
+class _SocketTransport(object):
+	"""Plain socket transport for programs which do not use Qt.
+
+	Outgoing data is queued and sent whenever the socket is writable, also
+	while waiting for incoming data. Thus large pipelined requests cannot
+	dead lock with the replies of the server.
+	"""
+
+	def __init__(self, host, port):
+		try:
+			self.socket = socket.create_connection((host, port), 1.0)
+		except socket.error:
+			raise IOError("Could not connect to server!")
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.socket.setblocking(False)
+		self.__out = bytearray()
+		self.__error = ''
+
+	def write(self, data):
+		self.__out.extend(data)
+		self.__send()
+
+	def read(self):
+		result = []
+		while True:
+			try:
+				data = self.socket.recv(0x10000)
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+					break
+				raise IOError("Error while receiving from server: " + str(e))
+			if not data:
+				if not result:
+					raise IOError("Connection closed by server!")
+				break
+			result.append(data)
+		return ''.join(result)
+
+	def wait(self, timeout):
+		# timeout in ms, negative values wait forever
+		if timeout < 0:
+			deadline = None
+		else:
+			deadline = time.time() + timeout / 1000.0
+		while True:
+			if deadline is None:
+				remaining = None
+			else:
+				remaining = max(deadline - time.time(), 0)
+			wlist = [self.socket] if self.__out else []
+			try:
+				(r, w, x) = select.select([self.socket], wlist, [], remaining)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				self.__error = str(e)
+				return False
+			if w:
+				self.__send()
+			if r:
+				return True
+			if (not w) and (remaining is not None) and (remaining <= 0):
+				return False
+
+	def flush(self):
+		while self.__out:
+			select.select([], [self.socket], [], 10)
+			self.__send()
+
+	def errorString(self):
+		return self.__error
+
+	def close(self):
+		self.socket.close()
+
+	def __send(self):
+		try:
+			sent = self.socket.send(self.__out)
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			raise IOError("Could not send request to server: " + str(e))
+		del self.__out[:sent]
+
+
+class _Connector(_QObject):
 	ERROR_MSG           = 0x0000
 	INIT_MSG            = 0x0001
 	ENUM_MSG            = 0x0002
@@ -291,9 +666,15 @@ class _Connector(QtCore.QObject):
 	PROGRESS_REP_DOC = pb.ProgressStartInd.rep_doc
 	PROGRESS_REP_REV = pb.ProgressStartInd.rep_rev
 
-	watchReady = QtCore.pyqtSignal()
+	# maximum size of the revision cache in bytes
+	CACHE_SIZE = 0x800000
 
-	def __init__(self, address=None):
+	if QtCore:
+		watchReady = QtCore.pyqtSignal()
+
+	def __init__(self, address=None, cache=None, qt=True):
+		# Connections which are used from other threads than the Qt main
+		# thread must pass qt=False to get a plain socket transport.
 		super(_Connector, self).__init__()
 
 		if not address:
@@ -331,26 +712,28 @@ class _Connector(QtCore.QObject):
 		if not address.startswith("tcp://"):
 			raise IOError("Unknown address scheme: " + address)
 
+		self.address = address
 		(address, cookie) = address[6:].split("/")
 		(host, port) = address.split(':')
 		port = int(port)
 		cookie = cookie.strip().decode('hex')
 
-		self.socket = QtNetwork.QTcpSocket()
-		self.socket.readyRead.connect(self.__readReady)
-		self.socket.connectToHost(host, port)
-		if not self.socket.waitForConnected(1000):
-			raise IOError("Could not connect to server!")
-		self.socket.setSocketOption(QtNetwork.QAbstractSocket.LowDelayOption, 1)
+		self.qt = bool(QtNetwork) and qt
+		if self.qt:
+			self.transport = _QtTransport(host, port, self.__readReady)
+		else:
+			self.transport = _SocketTransport(host, port)
 		self.next = 0
-		self.buf = ''
+		self.reader = _PacketReader()
+		self.cache = cache or _RevCache(_Connector.CACHE_SIZE)
 		self.confirmations = {}
 		self.indications = []
 		self.watchHandlers = {}
 		self.progressHandlers = []
 		self.recursion = 0
 
-		self.watchReady.connect(self.__dispatchIndications, QtCore.Qt.QueuedConnection)
+		if self.qt:
+			self.watchReady.connect(self.__dispatchIndications, QtCore.Qt.QueuedConnection)
 
 		try:
 			req = pb.InitReq()
@@ -363,53 +746,91 @@ class _Connector(QtCore.QObject):
 				raise IOError("Unsupported protocol version!")
 			self.maxPacketSize = cnf.max_packet_size
 		except:
-			self.socket.disconnectFromHost()
+			self.transport.close()
 			raise
 
 	def enum(self):
 		reply = pb.EnumCnf.FromString(self._rpc(_Connector.ENUM_MSG))
 		return Enum(reply)
 
-	def lookupDoc(self, doc, stores=[]):
+	# The query functions below take an optional 'pipelined' argument. If set
+	# the request is only sent and a Future is returned instead of the result.
+	# Many requests can thus be put on the wire back to back and their
+	# confirmations are collected later via Future.result().
+
+	def lookupDoc(self, doc, stores=[], pipelined=False):
 		req = pb.LookupDocReq()
 		req.doc = _checkUuid(doc)
 		for store in stores:
 			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.LOOKUP_DOC_MSG, req.SerializeToString())
+		return self._rpc(_Connector.LOOKUP_DOC_MSG, req.SerializeToString(),
+			done=self.__lookupDocDone, pipelined=pipelined)
+
+	def __lookupDocDone(self, reply):
 		return Lookup(pb.LookupDocCnf.FromString(reply))
 
-	def lookupRev(self, rev, stores=[]):
+	def lookupRev(self, rev, stores=[], pipelined=False):
 		req = pb.LookupRevReq()
 		req.rev = _checkUuid(rev)
 		for store in stores:
 			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.LOOKUP_REV_MSG, req.SerializeToString())
+		return self._rpc(_Connector.LOOKUP_REV_MSG, req.SerializeToString(),
+			done=self.__lookupRevDone, pipelined=pipelined)
+
+	def __lookupRevDone(self, reply):
 		return pb.LookupRevCnf.FromString(reply).stores
 
-	def stat(self, rev, stores=[]):
+	def stat(self, rev, stores=[], pipelined=False):
 		req = pb.StatReq()
 		req.rev = _checkUuid(rev)
 		for store in stores:
 			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.STAT_MSG, req.SerializeToString())
-		return Stat(pb.StatCnf.FromString(reply))
-
-	def getLinks(self, rev, stores=[]):
+		stat = self.cache.lookup(rev, stores, 'stat')
+		if stat is not None:
+			return _ResolvedFuture(stat) if pipelined else stat
+		return self._rpc(_Connector.STAT_MSG, req.SerializeToString(),
+			done=lambda reply: self.__statDone(reply, rev, stores),
+			pipelined=pipelined)
+
+	def __statDone(self, reply, rev, stores):
+		stat = Stat(pb.StatCnf.FromString(reply))
+		self.cache.insert(rev, stores, 'stat', stat, _RevCache.STAT_SIZE, reply)
+		return stat
+
+	def getLinks(self, rev, stores=[], pipelined=False):
 		req = pb.GetLinksReq()
 		req.rev = _checkUuid(rev)
 		for store in stores:
 			req.stores.append(_checkUuid(store))
-		reply = self._rpc(_Connector.GET_LINKS_MSG, req.SerializeToString())
+		return self._rpc(_Connector.GET_LINKS_MSG, req.SerializeToString(),
+			done=self.__getLinksDone, pipelined=pipelined)
+
+	def __getLinksDone(self, reply):
 		cnf = pb.GetLinksCnf.FromString(reply)
 		return (cnf.doc_links, cnf.rev_links)
 
-	def peek(self, store, rev):
+	def peek(self, store, rev, pipelined=False):
 		req = pb.PeekReq()
 		req.store = _checkUuid(store)
 		req.rev = _checkUuid(rev)
-		reply = self._rpc(_Connector.PEEK_MSG, req.SerializeToString())
+		if self.cache.knows(rev, store):
+			# The revision was already seen in this process. Cached data can be
+			# read right away while the handle is opened in the background.
+			opening = self._rpc(_Connector.PEEK_MSG, req.SerializeToString(),
+				done=self.__peekHandleDone, pipelined=True)
+			handle = Handle(self, store, opening, None, rev, True)
+			return _ResolvedFuture(handle) if pipelined else handle
+		return self._rpc(_Connector.PEEK_MSG, req.SerializeToString(),
+			done=lambda reply: self.__peekDone(reply, store, rev),
+			pipelined=pipelined)
+
+	def __peekHandleDone(self, reply):
+		return pb.PeekCnf.FromString(reply).handle
+
+	def __peekDone(self, reply, store, rev):
+		self.cache.confirm(rev, [store])
 		cnf = pb.PeekCnf.FromString(reply)
-		return Handle(self, store, cnf.handle, None, rev)
+		return Handle(self, store, cnf.handle, None, rev, True)
 
 	def create(self, store, typ, creator):
 		req = pb.CreateReq()
@@ -451,18 +872,22 @@ class _Connector(QtCore.QObject):
 		cnf = pb.ResumeCnf.FromString(reply)
 		return Handle(self, store, cnf.handle, doc, rev)
 
-	def watch(self, w):
+	def watch(self, w, pipelined=False):
+		result = None
 		if w._incWatchRef() == 1:
 			(typ, h) = ref = w._getRef()
 			if ref not in self.watchHandlers:
 				req = pb.WatchAddReq()
 				req.type = typ
 				req.element = _checkUuid(h)
-				self._rpc(_Connector.WATCH_ADD_MSG, req.SerializeToString())
+				result = self._rpc(_Connector.WATCH_ADD_MSG,
+					req.SerializeToString(), pipelined=pipelined)
 				self.watchHandlers[ref] = []
 			tb = None #traceback.extract_stack()
 			self.watchHandlers[ref].append(weakref.ref(w,
 				lambda r, ref=ref, tb=tb: self.__delWatch(r, ref, tb)))
+		if pipelined:
+			return result
 
 	def __delWatch(self, watchObjRef, watchSpec, tb):
 		if tb:
@@ -588,22 +1013,60 @@ class _Connector(QtCore.QObject):
 		cnf = pb.GetPathCnf.FromString(reply)
 		return cnf.path
 
-	def walkPath(self, path):
+	def walkPath(self, path, pipelined=False):
 		req = pb.WalkPathReq()
 		req.path = path
-		reply = self._rpc(_Connector.WALK_PATH_MSG, req.SerializeToString())
+		return self._rpc(_Connector.WALK_PATH_MSG, req.SerializeToString(),
+			done=self.__walkPathDone, pipelined=pipelined)
+
+	def __walkPathDone(self, reply):
 		cnf = pb.WalkPathCnf.FromString(reply)
 		return [ (item.store, item.doc) for item in cnf.items ]
 
 	def flush(self):
-		while self.socket.flush():
-			self.socket.waitForBytesWritten(10000)
+		self.cache.flush()
+		self.transport.flush()
 
 	def process(self, timeout=1):
-		if self.socket.waitForReadyRead(timeout):
+		if self.transport.wait(timeout):
 			self.__readReady()
 		self.__dispatchIndications()
 
+	def _processWatches(self, cls):
+		# Dispatch the watch events which have already been received to the
+		# watches of class 'cls' only. All other handlers get them later
+		# through the regular dispatching. Events which have no other handlers
+		# are done and dropped, so the queue does not grow without an event
+		# loop.
+		self.recursion += 1
+		try:
+			while self.transport.wait(0):
+				self.__readReady()
+		finally:
+			self.recursion -= 1
+		pending = self.indications
+		self.indications = []
+		keep = []
+		for (msg, packet, served) in pending:
+			if (msg != _Connector.WATCH_MSG) or issubclass(cls, served):
+				keep.append((msg, packet, served))
+				continue
+			served = served + (cls,)
+			ind = pb.WatchInd.FromString(packet)
+			others = False
+			matches = self.watchHandlers.get((ind.type, ind.element), [])[:]
+			for i in matches:
+				i = i() # dereference weakref
+				if isinstance(i, cls):
+					i.triggered(ind.event, ind.store)
+				elif (i is not None) and not isinstance(i, served):
+					others = True
+			if others:
+				keep.append((msg, packet, served))
+			else:
+				self.__forgetDisappeared(ind)
+		self.indications = keep + self.indications
+
 	def regProgressHandler(self, start=None, progress=None, stop=None):
 		if start or progress:
 			cnf = pb.ProgressQueryCnf.FromString(self._rpc(_Connector.PROGRESS_QUERY_MSG, ''))
@@ -687,7 +1150,7 @@ class _Connector(QtCore.QObject):
 				error_cnf = pb.ErrorCnf.FromString(reply)
 				self.__callback(IOError(_errorCodes[error_cnf.error]))
 
-	def _rpc(self, msg, request = '', async=None, done=lambda x: x):
+	def _rpc(self, msg, request = '', async=None, done=lambda x: x, pipelined=False):
 		ref = self.__make_ref()
 		req_msg = (msg << 4) | _Connector.FLAG_REQ
 		if async:
@@ -696,49 +1159,46 @@ class _Connector(QtCore.QObject):
 			completion = _Connector._PollCompletion()
 		self.confirmations[ref] = completion
 		self.__send(struct.pack('>LH', ref, req_msg) + request)
-		if not async:
+		if async:
+			return None
+		elif pipelined:
+			return Future(self, msg, completion, done)
+		else:
 			start = time.time()
-			self.__poll(completion)
+			result = self._complete(msg, completion, done)
 			end = time.time()
 			#print "RPC sync:", _requestNames[msg], int((end-start)*1000000)
-			if completion.cnf == msg:
-				return done(completion.reply)
-			elif completion.cnf == _Connector.ERROR_MSG:
-				error_cnf = pb.ErrorCnf.FromString(completion.reply)
-				_raiseError(error_cnf.error)
-			else:
-				raise IOError("Invalid server reply!")
+			return result
+
+	def _complete(self, msg, completion, done):
+		self.__poll(completion)
+		if completion.cnf == msg:
+			return done(completion.reply)
+		elif completion.cnf == _Connector.ERROR_MSG:
+			error_cnf = pb.ErrorCnf.FromString(completion.reply)
+			_raiseError(error_cnf.error)
+		else:
+			raise IOError("Invalid server reply!")
 
 	# private functions
 
 	def __send(self, packet):
 		raw = struct.pack('>H', len(packet)) + packet
-		if self.socket.write(raw) == -1:
-			raise IOError("Could not send request to server: "
-				+ str(self.socket.errorString()))
+		self.transport.write(raw)
 
 	def __readReady(self):
 		# unpack incoming packets
 		indications = False
-		self.buf = self.buf + str(self.socket.readAll())
-		while len(self.buf) > 2:
-			expect = struct.unpack_from('>H', self.buf, 0)[0] + 2
-			if expect <= len(self.buf):
-				packet = self.buf[2:expect]
-				self.buf = self.buf[expect:]
-
-				# immediately remove indications
-				(ref, msg) = struct.unpack_from('>LH', packet, 0)
-				typ = msg & 3
-				msg = msg >> 4
-				if typ == _Connector.FLAG_IND:
-					indications = True
-					self.indications.append((msg, packet[6:]))
-				elif typ == _Connector.FLAG_CNF:
-					self.confirmations[ref].setResult(msg, packet[6:])
-					del self.confirmations[ref]
-			else:
-				break
+		self.reader.feed(self.transport.read())
+		for (ref, msg, payload) in self.reader.packets():
+			# immediately remove indications
+			typ = msg & 3
+			msg = msg >> 4
+			if typ == _Connector.FLAG_IND:
+				indications = True
+				self.indications.append((msg, payload, ()))
+			elif typ == _Connector.FLAG_CNF:
+				self.confirmations.pop(ref).setResult(msg, payload)
 
 		if indications:
 			self.__dispatchIndications()
@@ -751,15 +1211,16 @@ class _Connector(QtCore.QObject):
 				dispatched = False
 				indications = self.indications[:]
 				self.indications = []
-				for (msg, packet) in indications:
+				for (msg, packet, served) in indications:
 					dispatched = True
 					if msg == _Connector.WATCH_MSG:
 						ind = pb.WatchInd.FromString(packet)
+						self.__forgetDisappeared(ind)
 						# make explicit copy as watches may get modified by callouts!
 						matches = self.watchHandlers.get((ind.type, ind.element), [])[:]
 						for i in matches:
 							i = i() # dereference weakref
-							if i is not None:
+							if (i is not None) and not isinstance(i, served):
 								i.triggered(ind.event, ind.store)
 					elif msg == _Connector.PROGRESS_START_MSG:
 						ind = pb.ProgressStartInd.FromString(packet)
@@ -775,9 +1236,16 @@ class _Connector(QtCore.QObject):
 						for (event, handler) in handlers:
 							if event == msg:
 								handler(ind.tag)
-		else:
+		elif self.qt:
 			self.watchReady.emit()
 
+	def __forgetDisappeared(self, ind):
+		if ind.event == pb.WatchInd.disappeared:
+			if ind.type == pb.WatchInd.rev:
+				self.cache.forgetRev(ind.element, ind.store)
+			else:
+				self.cache.forgetStore(ind.store)
+
 	def __dispatchProgressStart(self, ind, handlers):
 		for handler in handlers:
 			if ind.HasField('item'):
@@ -798,9 +1266,9 @@ class _Connector(QtCore.QObject):
 		try:
 			# loop until we've received the answer
 			while completion.pending:
-				if not self.socket.waitForReadyRead(-1):
+				if not self.transport.wait(-1):
 					raise IOError("Error while waiting for data from server: "
-						+ str(self.socket.errorString()))
+						+ self.transport.errorString())
 				self.__readReady()
 		finally:
 			self.recursion -= 1
@@ -811,6 +1279,86 @@ class _Connector(QtCore.QObject):
 		return ref
 
 
+class _ResolvedFuture(object):
+	"""Future of a request that could be answered without the server."""
+	__slots__ = ['__result']
+
+	def __init__(self, result):
+		self.__result = result
+
+	def ready(self):
+		return True
+
+	def result(self):
+		return self.__result
+
+
+class Future(object):
+	"""Pending result of a pipelined request.
+
+	The confirmation is collected on the first call of result(). Until then
+	other requests may be sent and answered in any order. The result (or the
+	error) is kept, so calling result() again does not repeat the request.
+	"""
+	__slots__ = ['__connector', '__msg', '__completion', '__done', '__result',
+		'__error']
+
+	def __init__(self, connector, msg, completion, done):
+		self.__connector = connector
+		self.__msg = msg
+		self.__completion = completion
+		self.__done = done
+		self.__result = None
+		self.__error = None
+
+	def ready(self):
+		return not self.__completion.pending
+
+	def result(self):
+		if self.__connector:
+			try:
+				self.__result = self.__connector._complete(self.__msg,
+					self.__completion, self.__done)
+			except Exception as e:
+				self.__error = e
+			finally:
+				self.__connector = None
+				self.__done = None
+		if self.__error:
+			raise self.__error
+		return self.__result
+
+
+def pipeline(tasks, window=None):
+	"""Run a list of generators in lock step.
+
+	Each task sends its pipelined requests and yields before collecting the
+	results. Because every task is advanced once per round, all requests of a
+	round are on the wire at the same time and the whole list takes one round
+	trip per step instead of one per request and task.
+
+	If 'window' is given at most that many tasks run at the same time. A new
+	task is started whenever one has finished.
+	"""
+	tasks = iter(tasks)
+	pending = []
+	while True:
+		if window is None:
+			pending.extend(tasks)
+		else:
+			pending.extend(itertools.islice(tasks, window - len(pending)))
+		if not pending:
+			break
+		remaining = []
+		for task in pending:
+			try:
+				task.next()
+				remaining.append(task)
+			except StopIteration:
+				pass
+		pending = remaining
+
+
 class Watch(object):
 	EVENT_MODIFIED    = pb.WatchInd.modified
 	EVENT_APPEARED    = pb.WatchInd.appeared
@@ -1011,15 +1559,34 @@ class Stat(object):
 
 
 class Handle(object):
-	def __init__(self, connector, store, handle, doc, rev):
+	# number of read requests kept in flight by iterRead()/read()/readAll()
+	READ_AHEAD = 16
+	# number of unconfirmed write requests and packets per write commit
+	WRITE_AHEAD = 16
+	WRITE_BATCH = 256
+	# read transfers of revisions are striped over the bulk connections
+	# after this many bytes
+	STRIPE_MIN = 0x40000
+
+	def __init__(self, connector, store, handle, doc, rev, cached=False):
 		self.__pos = { }
 		self.connector = connector
 		self.__store = store
-		self.handle = handle
+		self.__handle = handle
+		self.__cached = cached
+		self.__stripes = None
 		self.doc = doc
 		self.rev = rev
 		self.active = True
 
+	@property
+	def handle(self):
+		# Read only handles of known revisions are opened in the background.
+		# See _Connector.peek().
+		if isinstance(self.__handle, Future):
+			self.__handle = self.__handle.result()
+		return self.__handle
+
 	def __enter__(self):
 		return self
 
@@ -1041,13 +1608,30 @@ class Handle(object):
 	def _setPos(self, part, pos):
 		self.__pos[part] = pos
 
-	def getData(self, selector):
+	def getData(self, selector, pipelined=False, lazy=False):
+		if self.__cached:
+			data = self.connector.cache.lookup(self.rev, [self.__store],
+				('data', selector))
+			if data is not None:
+				data = loadPDSD(self.__store, data, lazy)
+				return _ResolvedFuture(data) if pipelined else data
+		return self.__getRawData(selector,
+			lambda data: loadPDSD(self.__store, data, lazy), pipelined)
+
+	def __getRawData(self, selector, decode, pipelined=False):
 		req = pb.GetDataReq()
 		req.handle = self.handle
 		req.selector = selector
-		reply = self.connector._rpc(_Connector.GET_DATA_MSG, req.SerializeToString())
+		return self.connector._rpc(_Connector.GET_DATA_MSG, req.SerializeToString(),
+			done=lambda reply: decode(self.__getDataDone(reply, selector)),
+			pipelined=pipelined)
+
+	def __getDataDone(self, reply, selector):
 		data = pb.GetDataCnf.FromString(reply).data
-		return loadPDSD(self.__store, data)
+		if self.__cached:
+			self.connector.cache.insert(self.rev, [self.__store],
+				('data', selector), data, len(data), data)
+		return data
 
 	def setData(self, selector, data):
 		req = pb.SetDataReq()
@@ -1071,67 +1655,208 @@ class Handle(object):
 	def read(self, part, length):
 		if not self.active:
 			raise IOError('Handle expired')
-		result = ''
 		pos = self._getPos(part)
-		packetSize = self.connector.maxPacketSize
-		while length > 0:
-			if length > packetSize:
-				chunk = packetSize
-			else:
-				chunk = length
-			req = pb.ReadReq()
-			req.handle = self.handle
-			req.part = part
-			req.offset = pos
-			req.length = chunk
-			reply = self.connector._rpc(_Connector.READ_MSG, req.SerializeToString())
-			data = pb.ReadCnf.FromString(reply).data
-			size = len(data)
-			result = result + data
-			pos = pos + size
-			if size < chunk:
-				break
+		result = []
+		for data in self.__readPackets(part, pos, length):
+			result.append(data)
+			pos += len(data)
 		self._setPos(part, pos)
-		return result
+		return ''.join(result)
 
 	def readAll(self, part):
-		result = ''
-		oldPos = self._getPos(part)
-		try:
-			self._setPos(part, 0)
-			while True:
-				chunk = self.read(part, 0x20000)
-				result = result + chunk
-				if len(chunk) < 0x20000:
-					break
-			return result
-		finally:
-			self._setPos(part, oldPos)
-
-	def write(self, part, data):
 		if not self.active:
 			raise IOError('Handle expired')
+		if self.__cached:
+			data = self.connector.cache.lookup(self.rev, [self.__store],
+				('part', part))
+			if data is not None:
+				return data
+		data = ''.join(self.__readPackets(part, 0))
+		if self.__cached and len(data) <= _RevCache.MAX_BLOB:
+			self.connector.cache.insert(self.rev, [self.__store], ('part', part),
+				data, len(data))
+		return data
 
+	def iterPDSD(self, part, path=[]):
+		"""Decode a PDSD encoded part incrementally while it is read.
+
+		Yields the entries of the dict or list (see iterPDSD()) as soon as
+		they have been received, i.e. before the whole part is transferred.
+		"""
+		if not self.active:
+			raise IOError('Handle expired')
+		chunks = None
+		if self.__cached:
+			data = self.connector.cache.lookup(self.rev, [self.__store],
+				('part', part))
+			if data is not None:
+				chunks = [data]
+		if chunks is None:
+			chunks = self.__readPackets(part, 0)
+		return iterPDSD(self.__store, chunks, path)
+
+	def iterRead(self, part, chunk=0x20000):
+		"""Iterate over a part from the current position to its end.
+
+		Yields strings of 'chunk' bytes (the last one may be shorter). Only
+		READ_AHEAD requests are in flight at any time, so the memory usage is
+		bounded regardless of the size of the part.
+		"""
+		if not self.active:
+			raise IOError('Handle expired')
 		pos = self._getPos(part)
+		pending = []
+		size = 0
+		for data in self.__readPackets(part, pos):
+			pending.append(data)
+			size += len(data)
+			while size >= chunk:
+				buf = ''.join(pending)
+				pending = [buf[chunk:]]
+				size -= chunk
+				pos += chunk
+				self._setPos(part, pos)
+				yield buf[:chunk]
+		if size:
+			self._setPos(part, pos + size)
+			yield ''.join(pending)
+
+	def __readPackets(self, part, pos, length=None):
+		# Yield the part starting at 'pos' in packets of at most maxPacketSize
+		# bytes. The first request is sent alone so that small parts cost a
+		# single round trip. Each full packet doubles the window up to
+		# READ_AHEAD requests per connection.
+		packetSize = self.connector.maxPacketSize
+		end = None if length is None else pos + length
+		window = collections.deque()
+		offset = pos
+		readers = [(self.connector, self.handle)]
+		ahead = 1
 		i = 0
-		length = len(data)
+		while True:
+			if (len(readers) == 1) and (offset - pos >= Handle.STRIPE_MIN):
+				readers = self.__getStripes()
+			while (len(window) < ahead * len(readers)) and \
+			      (end is None or offset < end):
+				(connector, handle) = readers[i % len(readers)]
+				i += 1
+				size = packetSize if end is None else min(packetSize, end - offset)
+				req = pb.ReadReq()
+				req.handle = handle
+				req.part = part
+				req.offset = offset
+				req.length = size
+				window.append((size, connector._rpc(_Connector.READ_MSG,
+					req.SerializeToString(), done=self.__readDone, pipelined=True)))
+				offset += size
+			if not window:
+				break
+			(size, future) = window.popleft()
+			data = future.result()
+			yield data
+			if len(data) < size:
+				break
+			ahead = min(ahead * 2, Handle.READ_AHEAD)
+
+		# requests beyond the end of the part
+		for (size, future) in window:
+			try:
+				future.result()
+			except IOError:
+				pass
+
+	def __readDone(self, reply):
+		return pb.ReadCnf.FromString(reply).data
+
+	def __getStripes(self):
+		# Handles are bound to their connection. To stripe a read over the
+		# bulk connections the revision is opened on each of them too. This
+		# is only possible for revisions, documents are read from one
+		# connection.
+		if self.__stripes is None:
+			self.__stripes = [(self.connector, self.handle)]
+			if self.__cached:
+				req = pb.PeekReq()
+				req.store = self.__store
+				req.rev = self.rev
+				req = req.SerializeToString()
+				opening = [ (c, c._rpc(_Connector.PEEK_MSG, req, pipelined=True))
+					for c in _bulkConnectors() if c is not self.connector ]
+				for (connector, future) in opening:
+					try:
+						handle = pb.PeekCnf.FromString(future.result()).handle
+						self.__stripes.append((connector, handle))
+					except IOError:
+						pass
+		return self.__stripes
+
+	def __closeStripes(self):
+		if self.__stripes:
+			for (connector, handle) in self.__stripes[1:]:
+				req = pb.CloseReq()
+				req.handle = handle
+				connector._rpc(_Connector.CLOSE_MSG, req.SerializeToString(),
+					pipelined=True)
+			self.__stripes = None
+
+	def write(self, part, data):
+		if not self.active:
+			raise IOError('Handle expired')
+		packetSize = self.connector.maxPacketSize
+		packets = ( data[i:i+packetSize] for i in xrange(0, len(data), packetSize) )
+		pos = self.__writePackets(part, self._getPos(part), packets)
+		self._setPos(part, pos)
+
+	def writeFrom(self, part, fileobj):
+		"""Write the remaining content of a file like object to a part.
+
+		The data is read in packet sized pieces and sent without waiting for
+		each confirmation. Neither the client nor the server buffer more than a
+		bounded amount of data, regardless of the size of the file.
+		"""
+		if not self.active:
+			raise IOError('Handle expired')
 		packetSize = self.connector.maxPacketSize
-		while length > i+packetSize:
-			req = pb.WriteBufferReq()
+		packets = iter(lambda: fileobj.read(packetSize), '')
+		pos = self.__writePackets(part, self._getPos(part), packets)
+		self._setPos(part, pos)
+
+	def __writePackets(self, part, pos, packets):
+		# The server keeps WRITE_BUFFER_MSG data until the next
+		# WRITE_COMMIT_MSG, so commit every WRITE_BATCH packets. At most
+		# WRITE_AHEAD requests are unconfirmed at any time.
+		window = collections.deque()
+		offset = pos
+		batch = 0
+		packets = iter(packets)
+		data = next(packets, '')
+		while True:
+			following = next(packets, None)
+			batch += 1
+			if (following is not None) and (batch < Handle.WRITE_BATCH):
+				msg = _Connector.WRITE_BUFFER_MSG
+				req = pb.WriteBufferReq()
+			else:
+				msg = _Connector.WRITE_COMMIT_MSG
+				req = pb.WriteCommitReq()
+				req.offset = offset
+				offset = pos + len(data)
+				batch = 0
 			req.handle = self.handle
 			req.part = part
-			req.data = data[i:i+packetSize]
-			self.connector._rpc(_Connector.WRITE_BUFFER_MSG, req.SerializeToString())
-			i += packetSize
-
-		req = pb.WriteCommitReq()
-		req.handle = self.handle
-		req.part = part
-		req.offset = pos
-		req.data = data[i:i+packetSize]
-		self.connector._rpc(_Connector.WRITE_COMMIT_MSG, req.SerializeToString())
+			req.data = data
+			window.append(self.connector._rpc(msg, req.SerializeToString(),
+				pipelined=True))
+			pos += len(data)
+			if len(window) > Handle.WRITE_AHEAD:
+				window.popleft().result()
+			if following is None:
+				break
+			data = following
 
-		self._setPos(part, pos+length)
+		for future in window:
+			future.result()
+		return pos
 
 	def writeAll(self, part, data):
 		self._setPos(part, 0)
@@ -1167,22 +1892,36 @@ class Handle(object):
 		cnf = pb.SuspendCnf.FromString(reply)
 		self.rev = cnf.rev
 
-	def close(self):
-		if self.active:
-			self.active = False
-			req = pb.CloseReq()
-			req.handle = self.handle
-			self.connector._rpc(_Connector.CLOSE_MSG, req.SerializeToString())
-		else:
+	def close(self, pipelined=False):
+		if not self.active:
 			raise IOError('Handle expired')
+		self.active = False
+		self.__closeStripes()
+		try:
+			handle = self.handle
+		except IOError:
+			# opening in the background failed, nothing to close
+			return _ResolvedFuture(None) if pipelined else None
+		req = pb.CloseReq()
+		req.handle = handle
+		return self.connector._rpc(_Connector.CLOSE_MSG,
+			req.SerializeToString(), pipelined=pipelined)
 
 	def stat(self):
 		if not self.active:
 			raise IOError('Handle expired')
+		if self.__cached:
+			stat = self.connector.cache.lookup(self.rev, [self.__store], 'stat')
+			if stat is not None:
+				return stat
 		req = pb.FStatReq()
 		req.handle = self.handle
 		reply = self.connector._rpc(_Connector.FSTAT_MSG, req.SerializeToString())
-		return Stat(pb.StatCnf.FromString(reply))
+		stat = Stat(pb.StatCnf.FromString(reply))
+		if self.__cached:
+			self.connector.cache.insert(self.rev, [self.__store], 'stat', stat,
+				_RevCache.STAT_SIZE, reply)
+		return stat
 
 	def setFlags(self, flags):
 		if not self.active:
@@ -1267,9 +2006,16 @@ class ReplicateHandle(object):
 			raise IOError('Handle expired')
 
 _connection = None
+_bulkPool = []
+_bulkNext = 0
+
+# number of additional connections for bulk transfers
+BULK_CONNECTIONS = 3
 
 def __FlushConnection():
 	global _connection
+	for connection in _bulkPool:
+		connection.flush()
 	if _connection:
 		_connection.flush()
 
@@ -1280,6 +2026,177 @@ def Connector(address=None):
 		atexit.register(__FlushConnection)
 	return _connection
 
+def _bulkConnectors():
+	# Open the bulk connections lazily to the same daemon as Connector(). They
+	# share the revision cache of the main connection.
+	main = Connector()
+	while len(_bulkPool) < BULK_CONNECTIONS:
+		try:
+			_bulkPool.append(_Connector(main.address, main.cache))
+		except IOError:
+			break
+	return _bulkPool or [main]
+
+def BulkConnector():
+	"""Get a connection for large transfers.
+
+	Returns one of the BULK_CONNECTIONS additional connections in a round
+	robin fashion. Handles opened on them do not hold up the requests on the
+	main connection, e.g. while importing large files.
+	"""
+	global _bulkNext
+	pool = _bulkConnectors()
+	_bulkNext = (_bulkNext + 1) % len(pool)
+	return pool[_bulkNext]
+
+
+###############################################################################
+# Path resolution cache
+###############################################################################
+
+class _PathCache(object):
+	"""Cache of paths ("label:path/to/doc") resolved by the server.
+
+	All prefixes of a path are resolved together in one round trip. The
+	documents found on the way are watched. Any change of one of them (folder
+	content, title) invalidates all paths which lead through it. A change of
+	the document a path resolves to invalidates the path only if its title no
+	longer matches, so saving a folder keeps the path to it cached.
+	"""
+	# maximum number of cached paths
+	MAX_PATHS = 256
+
+	class _DocWatch(Watch):
+		def __init__(self, cache, doc):
+			super(_PathCache._DocWatch, self).__init__(Watch.TYPE_DOC, doc)
+			self.__cache = cache
+
+		def triggered(self, cause, store):
+			self.__cache._invalidate(self.getHash(), cause, store)
+
+	def __init__(self):
+		self.__paths = { } # path -> (items, docs on the way, docs before items)
+		self.__users = { } # doc -> set of paths through doc
+		self.__watches = { } # doc -> _DocWatch
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	def walkPath(self, path):
+		c = Connector()
+		c._processWatches(_PathCache._DocWatch) # apply pending invalidations
+		if path in self.__paths:
+			self.hits += 1
+			return self.__paths[path][0]
+		self.misses += 1
+		prefixes = self.__prefixes(path)
+		if prefixes is None:
+			return c.walkPath(path)
+
+		# resolve all unknown prefixes at once
+		futures = [ (prefix, c.walkPath(prefix, pipelined=True)) for prefix
+			in prefixes if prefix not in self.__paths ]
+		items = { }
+		for (prefix, future) in futures:
+			try:
+				items[prefix] = future.result()
+			except IOError:
+				pass
+		if path not in items:
+			return c.walkPath(path) # raises the right error
+
+		if len(self.__paths) + len(items) > _PathCache.MAX_PATHS:
+			# keep the prefixes of the new path
+			for prefix in prefixes:
+				if prefix in self.__paths:
+					items[prefix] = self.__paths[prefix][0]
+			self.clear()
+		docs = set()
+		for prefix in prefixes:
+			if prefix in self.__paths:
+				(prefixItems, prefixDocs, way) = self.__paths[prefix]
+			elif prefix in items:
+				prefixItems = items[prefix]
+				prefixDocs = docs | set(doc for (store, doc) in prefixItems)
+				self.__insert(prefix, prefixItems, prefixDocs, docs)
+			else:
+				break
+			docs = prefixDocs
+		return items[path]
+
+	def clear(self):
+		for watch in self.__watches.values():
+			Connector().unwatch(watch)
+		self.__paths = { }
+		self.__users = { }
+		self.__watches = { }
+
+	def _invalidate(self, doc, cause, store):
+		users = self.__users.get(doc, set())
+		for path in list(users):
+			if path in self.__paths:
+				way = self.__paths[path][2]
+				if (cause == Watch.EVENT_MODIFIED) and (doc not in way) and \
+				   self.__titleMatches(path, store, doc):
+					# only the content of the target changed
+					continue
+				del self.__paths[path]
+				self.invalidations += 1
+			users.discard(path)
+		if not users:
+			self.__users.pop(doc, None)
+			if doc in self.__watches:
+				Connector().unwatch(self.__watches.pop(doc))
+
+	@staticmethod
+	def __titleMatches(path, store, doc):
+		# The store root is found by its label, other documents by title.
+		rest = path.split(':', 1)[1]
+		if not rest:
+			return True
+		name = rest.split('/')[-1]
+		if isinstance(name, str):
+			name = name.decode('utf8')
+		try:
+			c = Connector()
+			rev = c.lookupDoc(doc, [store]).rev(store)
+			with c.peek(store, rev) as r:
+				title = r.getData("/org.peerdrive.annotation/title")
+		except (IOError, KeyError):
+			return False
+		return title == name
+
+	def __insert(self, path, items, docs, way):
+		self.__paths[path] = (items, docs, way)
+		for doc in docs:
+			self.__users.setdefault(doc, set()).add(path)
+			if doc not in self.__watches:
+				watch = _PathCache._DocWatch(self, doc)
+				self.__watches[doc] = watch
+				Connector().watch(watch)
+
+	@staticmethod
+	def __prefixes(path):
+		# "label:a/b" -> ["label:", "label:a", "label:a/b"]
+		parts = path.split(':')
+		if len(parts) != 2:
+			return None
+		(label, rest) = parts
+		prefixes = [label + ':']
+		if rest:
+			steps = rest.split('/')
+			for i in xrange(len(steps)):
+				prefixes.append(label + ':' + '/'.join(steps[:i+1]))
+		return prefixes
+
+_pathCache = None
+
+def PathCache():
+	global _pathCache
+	if not _pathCache:
+		_pathCache = _PathCache()
+	return _pathCache
+
 
 ###############################################################################
 # PDSD data structures, encoders and decoders
@@ -1298,7 +2215,7 @@ def Link(spec):
 		return link
 	else:
 		# FIXME: this assumes that we will only ever get single doc links o_O
-		[(store, doc)] = Connector().walkPath(spec)
+		[(store, doc)] = PathCache().walkPath(spec)
 		return DocLink(store, doc, False)
 
 class RevLink(object):
@@ -1347,7 +2264,7 @@ class RevLink(object):
 		self.__store = store.decode("hex")
 		self.__rev = rev.decode("hex")
 
-	def update(self, newStore=None):
+	def update(self, newStore=None, lookup=None):
 		if newStore:
 			self.__store = newStore
 		return self
@@ -1416,17 +2333,27 @@ class DocLink(object):
 		self.__doc = doc.decode("hex")
 		self.__rev = None
 
-	def update(self, newStore=None):
+	def update(self, newStore=None, lookup=None):
+		"""Lookup the current revision of the document in the link's store.
+
+		An already available (possibly pipelined) lookup result of the document
+		may be passed to avoid another request.
+		"""
 		if newStore:
 			self.__store = newStore
-		l = Connector().lookupDoc(self.__doc, [self.__store])
-		if self.__store in l.stores():
-			self.__rev = l.rev(self.__store)
+		if lookup is None:
+			lookup = Connector().lookupDoc(self.__doc, [self.__store])
+		if self.__store in lookup.stores():
+			self.__rev = lookup.rev(self.__store)
 		else:
 			self.__rev = None
 		self.__updated = True
 		return self
 
+	def updated(self):
+		"""Return whether the current revision has already been looked up."""
+		return self.__updated
+
 	def doc(self):
 		return self.__doc
 
@@ -1439,23 +2366,164 @@ class DocLink(object):
 		return self.__store
 
 
+# Precompiled scalar formats of the PDSD encoding
+_PDSD_SCALARS = dict([ (code, struct.Struct('<'+code)) for code in
+	['B', 'b', 'H', 'h', 'L', 'l', 'Q', 'q', 'f', 'd'] ])
+_PDSD_LENGTH = _PDSD_SCALARS['L']
+
 class Decoder(object):
+	# tag -> scalar format of plain values
+	SCALARS = {
+		0x50 : _PDSD_SCALARS['f'],
+		0x51 : _PDSD_SCALARS['d'],
+		0x60 : _PDSD_SCALARS['B'],
+		0x61 : _PDSD_SCALARS['b'],
+		0x62 : _PDSD_SCALARS['H'],
+		0x63 : _PDSD_SCALARS['h'],
+		0x64 : _PDSD_SCALARS['L'],
+		0x65 : _PDSD_SCALARS['l'],
+		0x66 : _PDSD_SCALARS['Q'],
+		0x67 : _PDSD_SCALARS['q'],
+	}
+
 	def __init__(self, store):
 		self.__store = store
-		pass
+		# tag -> function(s, i) of compound values returning (value, next i)
+		self.__compound = {
+			0x00 : self.__decodeDict,
+			0x10 : self.__decodeList,
+			0x20 : self.__decodeString,
+			0x30 : self.__decodeBool,
+			0x40 : self.__decodeRevLink,
+			0x41 : self.__decodeDocLink,
+		}
 
 	def decode(self, s):
 		self._s = s
 		self._i = 0
 		return self._decodeDoc()
 
+	def decodeLazy(self, s):
+		"""Decode dicts and lists as LazyDict/LazyList views of 's'."""
+		return self._decodeLazy(s, 0)
+
+	def _decodeLazy(self, s, i):
+		tag = ord(s[i])
+		if tag == 0x00:
+			return LazyDict(self, s, i)
+		elif tag == 0x10:
+			return LazyList(self, s, i)
+		else:
+			return self.__decode(s, i)[0]
+
+	def _decodeAt(self, s, i):
+		return self.__decode(s, i)
+
+	def _skip(self, s, i):
+		# return the end of the value at 'i' without decoding it
+		tag = ord(s[i])
+		fmt = Decoder.SCALARS.get(tag)
+		if fmt is not None:
+			return i + 1 + fmt.size
+		elif tag == 0x00:
+			unpack = _PDSD_LENGTH.unpack_from
+			skip = self._skip
+			elements = unpack(s, i+1)[0]
+			i += 5
+			for x in xrange(elements):
+				i = skip(s, i + 4 + unpack(s, i)[0])
+			return i
+		elif tag == 0x10:
+			skip = self._skip
+			elements = _PDSD_LENGTH.unpack_from(s, i+1)[0]
+			i += 5
+			for x in xrange(elements):
+				i = skip(s, i)
+			return i
+		elif tag == 0x20:
+			return i + 5 + _PDSD_LENGTH.unpack_from(s, i+1)[0]
+		elif tag == 0x30:
+			return i + 2
+		elif tag in (0x40, 0x41):
+			return i + 2 + ord(s[i+1])
+		else:
+			raise TypeError("Invalid tag")
+
+	def iterDecode(self, chunks, path=[]):
+		"""Incrementally decode a dict or list from an iterable of strings.
+
+		Yields (key, value) for every dict entry or (index, item) for every
+		list item as soon as it is complete. The dict keys or list indices in
+		'path' select a nested dict or list instead. Only the not yet decoded
+		rest of the data is kept. Truncated data raises TypeError, invalid
+		UTF-8 raises UnicodeDecodeError.
+		"""
+		state = ['', 0, iter(chunks)] # buffer, position, chunks
+
+		def complete(decode):
+			# Decode one element. If it is incomplete, wait until the unused
+			# part of the buffer has doubled before starting over, so that
+			# elements spanning many chunks are still decoded in linear time.
+			while True:
+				(s, i) = state[0:2]
+				error = TypeError("Truncated data")
+				try:
+					(value, end) = decode(s, i)
+					if end <= len(s):
+						state[1] = end
+						return value
+				except (IndexError, struct.error):
+					pass
+				except UnicodeDecodeError as e:
+					# only an error at the end of the string may be truncation
+					if e.end < len(e.object):
+						raise
+					error = e
+				need = max(len(s) - i, 1)
+				more = []
+				while need > 0:
+					chunk = next(state[2], None)
+					if chunk is None:
+						break
+					more.append(chunk)
+					need -= len(chunk)
+				if not more:
+					raise error
+				state[0:2] = [s[i:] + ''.join(more), 0]
+
+		path = list(path)
+		while True:
+			(tag, elements) = complete(self.__decodeHeader)
+			for index in xrange(elements):
+				if tag == 0x00:
+					key = complete(self.__decodeString)
+				else:
+					key = index
+				if path:
+					if key == path[0]:
+						break
+					complete(self.__decode) # skip
+				else:
+					yield (key, complete(self.__decode))
+			else:
+				if path:
+					raise KeyError(path[0])
+				return
+			del path[0]
+
+	def __decodeHeader(self, s, i):
+		tag = ord(s[i])
+		if tag not in (0x00, 0x10):
+			raise TypeError("Not a dict or list")
+		return (tag, _PDSD_LENGTH.unpack_from(s, i+1)[0]), i+5
+
 	def _getStore(self):
 		return self.__store
 
 	def _getInt(self, code):
-		length = struct.calcsize('<'+code)
-		value = struct.unpack_from('<'+code, self._s, self._i)[0]
-		self._i += length
+		fmt = _PDSD_SCALARS[code]
+		value = fmt.unpack_from(self._s, self._i)[0]
+		self._i += fmt.size
 		return value
 
 	def _getStr(self, length):
@@ -1464,137 +2532,278 @@ class Decoder(object):
 		return res
 
 	def _decodeDoc(self):
-		tag = self._getInt('B')
-		if tag == 0x00:
-			res = self._decodeDict()
-		elif tag == 0x10:
-			res = self._decodeList()
-		elif tag == 0x20:
-			res = self._decodeString()
-		elif tag == 0x30:
-			res = (self._getInt('B') != 0)
-		elif tag == 0x40:
-			res = RevLink()
-			res._fromStruct(self)
-		elif tag == 0x41:
-			res = DocLink()
-			res._fromStruct(self)
-		elif tag == 0x50:
-			res = self._getInt('f')
-		elif tag == 0x51:
-			res = self._getInt('d')
-		elif tag == 0x60:
-			res = self._getInt('B')
-		elif tag ==	0x61:
-			res = self._getInt('b')
-		elif tag ==	0x62:
-			res = self._getInt('H')
-		elif tag ==	0x63:
-			res = self._getInt('h')
-		elif tag ==	0x64:
-			res = self._getInt('L')
-		elif tag ==	0x65:
-			res = self._getInt('l')
-		elif tag ==	0x66:
-			res = self._getInt('Q')
-		elif tag ==	0x67:
-			res = self._getInt('q')
-		else:
-			raise TypeError("Invalid tag")
+		(value, self._i) = self.__decode(self._s, self._i)
+		return value
 
-		return res
+	def __decode(self, s, i):
+		tag = ord(s[i])
+		fmt = Decoder.SCALARS.get(tag)
+		if fmt is not None:
+			return (fmt.unpack_from(s, i+1)[0], i + 1 + fmt.size)
+		try:
+			decode = self.__compound[tag]
+		except KeyError:
+			raise TypeError("Invalid tag")
+		return decode(s, i+1)
 
-	def _decodeDict(self):
-		elements = self._getInt('L')
+	def __decodeDict(self, s, i):
+		unpack = _PDSD_LENGTH.unpack_from
+		decode = self.__decode
+		elements = unpack(s, i)[0]
+		i += 4
 		d = { }
-		for i in range(elements):
-			key = self._decodeString()
-			value = self._decodeDoc()
-			d[key] = value
-		return d
-
-	def _decodeList(self):
-		elements = self._getInt('L')
+		for x in xrange(elements):
+			length = unpack(s, i)[0]
+			i += 4
+			key = s[i:i+length].decode('utf-8')
+			(d[key], i) = decode(s, i+length)
+		return d, i
+
+	def __decodeList(self, s, i):
+		decode = self.__decode
+		elements = _PDSD_LENGTH.unpack_from(s, i)[0]
+		i += 4
 		l = []
-		for i in range(elements):
-			l.append(self._decodeDoc())
-		return l
+		append = l.append
+		for x in xrange(elements):
+			(value, i) = decode(s, i)
+			append(value)
+		return l, i
+
+	def __decodeString(self, s, i):
+		length = _PDSD_LENGTH.unpack_from(s, i)[0]
+		i += 4
+		return s[i:i+length].decode('utf-8'), i+length
 
-	def _decodeString(self):
-		length = self._getInt('L')
-		value = self._getStr(length).decode('utf-8')
+	def __decodeBool(self, s, i):
+		return s[i] != '\x00', i+1
+
+	def __decodeRevLink(self, s, i):
+		length = ord(s[i])
+		return RevLink(self.__store, s[i+1:i+1+length]), i+1+length
+
+	def __decodeDocLink(self, s, i):
+		length = ord(s[i])
+		return DocLink(self.__store, s[i+1:i+1+length], False), i+1+length
+
+
+class LazyDict(collections.Mapping):
+	"""Read only dict which decodes its entries on first access.
+
+	Nested dicts and lists are lazy too. copy.deepcopy() returns a completely
+	decoded, mutable dict.
+	"""
+
+	def __init__(self, decoder, s, pos):
+		self.__decoder = decoder
+		self.__s = s
+		self.__pos = pos
+		self.__len = _PDSD_LENGTH.unpack_from(s, pos+1)[0]
+		self.__offsets = None
+		self.__values = { }
+
+	def __len__(self):
+		return self.__len
+
+	def __iter__(self):
+		return iter(self.__getOffsets())
+
+	def __contains__(self, key):
+		return key in self.__getOffsets()
+
+	def __getitem__(self, key):
+		try:
+			return self.__values[key]
+		except KeyError:
+			pass
+		value = self.__decoder._decodeLazy(self.__s, self.__getOffsets()[key])
+		self.__values[key] = value
+		return value
+
+	def __repr__(self):
+		return 'LazyDict(' + repr(dict(self.items())) + ')'
+
+	def __deepcopy__(self, memo):
+		return self.__decoder._decodeAt(self.__s, self.__pos)[0]
+
+	def _raw(self):
+		return self.__s[self.__pos:self.__decoder._skip(self.__s, self.__pos)]
+
+	def __getOffsets(self):
+		if self.__offsets is None:
+			s = self.__s
+			unpack = _PDSD_LENGTH.unpack_from
+			skip = self.__decoder._skip
+			offsets = { }
+			i = self.__pos + 5
+			for x in xrange(self.__len):
+				length = unpack(s, i)[0]
+				i += 4
+				key = s[i:i+length].decode('utf-8')
+				offsets[key] = i = i + length
+				i = skip(s, i)
+			self.__offsets = offsets
+		return self.__offsets
+
+
+class LazyList(collections.Sequence):
+	"""Read only list which decodes its items on first access.
+
+	Nested dicts and lists are lazy too. copy.deepcopy() returns a completely
+	decoded, mutable list.
+	"""
+
+	def __init__(self, decoder, s, pos):
+		self.__decoder = decoder
+		self.__s = s
+		self.__pos = pos
+		self.__len = _PDSD_LENGTH.unpack_from(s, pos+1)[0]
+		self.__offsets = None
+		self.__values = { }
+
+	def __len__(self):
+		return self.__len
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [ self[i] for i in xrange(*index.indices(self.__len)) ]
+		if index < 0:
+			index += self.__len
+		if not (0 <= index < self.__len):
+			raise IndexError("list index out of range")
+		try:
+			return self.__values[index]
+		except KeyError:
+			pass
+		value = self.__decoder._decodeLazy(self.__s, self.__getOffsets()[index])
+		self.__values[index] = value
 		return value
 
+	def __eq__(self, other):
+		if isinstance(other, (list, LazyList)):
+			return list(self) == list(other)
+		return NotImplemented
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		return result if result is NotImplemented else not result
+
+	def __repr__(self):
+		return 'LazyList(' + repr(list(self)) + ')'
+
+	def __deepcopy__(self, memo):
+		return self.__decoder._decodeAt(self.__s, self.__pos)[0]
+
+	def _raw(self):
+		return self.__s[self.__pos:self.__decoder._skip(self.__s, self.__pos)]
+
+	def __getOffsets(self):
+		if self.__offsets is None:
+			skip = self.__decoder._skip
+			offsets = []
+			i = self.__pos + 5
+			for x in xrange(self.__len):
+				offsets.append(i)
+				i = skip(self.__s, i)
+			self.__offsets = offsets
+		return self.__offsets
+
 
 class Encoder(object):
+	_TAG_LENGTH = struct.Struct('<BL')
+	_LENGTH = _PDSD_LENGTH
+	_FLOAT = struct.Struct('<Bd')
+	_INT8 = struct.Struct('<Bb')
+	_INT16 = struct.Struct('<Bh')
+	_INT32 = struct.Struct('<Bl')
+	_INT64 = struct.Struct('<Bq')
+	_UINT8 = struct.Struct('<BB')
+	_UINT16 = struct.Struct('<BH')
+	_UINT32 = struct.Struct('<BL')
+	_UINT64 = struct.Struct('<BQ')
+
 	def __init__(self):
 		pass
 
 	def encode(self, o):
-		if isinstance(o, dict):
-			res = self._encodeDict(o)
+		# All parts are collected in one list and joined once
+		parts = []
+		self.__encode(o, parts.append)
+		return ''.join(parts)
+
+	def __encode(self, o, out):
+		t = type(o)
+		if t is dict:
+			self._encodeDict(o, out)
+		elif t is unicode:
+			o = o.encode('utf-8')
+			out(Encoder._TAG_LENGTH.pack(0x20, len(o)) + o)
+		elif t is DocLink:
+			out(o._toStruct())
+		elif t is bool:
+			out('\x30\x01' if o else '\x30\x00')
+		elif t is int:
+			out(self._encodeInt(o))
+		elif t is list:
+			self._encodeList(o, out)
+		elif t is str:
+			out(Encoder._TAG_LENGTH.pack(0x20, len(o)) + o)
+		elif isinstance(o, dict):
+			self._encodeDict(o, out)
 		elif isinstance(o, (list, tuple)):
-			res = self._encodeList(o)
+			self._encodeList(o, out)
 		elif isinstance(o, basestring):
-			if isinstance(o, str):
-				res = struct.pack('<BL', 0x20, len(o)) + o
-			else:
-				encStr = o.encode('utf-8')
-				res = struct.pack('<BL', 0x20, len(encStr)) + encStr
-		elif o is True:
-			res = struct.pack('BB', 0x30, 1)
-		elif o is False:
-			res = struct.pack('BB', 0x30, 0)
-		elif isinstance(o, RevLink):
-			res = o._toStruct()
-		elif isinstance(o, DocLink):
-			res = o._toStruct()
+			if not isinstance(o, str):
+				o = o.encode('utf-8')
+			out(Encoder._TAG_LENGTH.pack(0x20, len(o)) + o)
+		elif isinstance(o, (RevLink, DocLink)):
+			out(o._toStruct())
 		elif isinstance(o, float):
-			res = struct.pack('<Bd', 0x51, o)
+			out(Encoder._FLOAT.pack(0x51, o))
 		elif isinstance(o, (int, long)):
-			res = self._encodeInt(o)
+			out(self._encodeInt(o))
+		elif isinstance(o, (LazyDict, LazyList)):
+			out(o._raw())
 		else:
 			raise TypeError("Invalid object: " + repr(o))
 
-		return res
-
-	def _encodeDict(self, d):
-		data = struct.pack('<BL', 0x00, len(d))
+	def _encodeDict(self, d, out):
+		encode = self.__encode
+		length = Encoder._LENGTH.pack
+		out(Encoder._TAG_LENGTH.pack(0x00, len(d)))
 		for key, value in d.iteritems():
-			if isinstance(key, basestring):
-				if isinstance(key, unicode):
-					key = key.encode('utf-8')
-			else:
+			if isinstance(key, unicode):
+				key = key.encode('utf-8')
+			elif not isinstance(key, str):
 				raise TypeError("Invalid dict key: " + repr(key))
-			data += struct.pack('<L', len(key)) + key + self.encode(value)
+			out(length(len(key)) + key)
+			encode(value, out)
 
-		return data
-
-	def _encodeList(self, l):
-		data = struct.pack('<BL', 0x10, len(l))
+	def _encodeList(self, l, out):
+		encode = self.__encode
+		out(Encoder._TAG_LENGTH.pack(0x10, len(l)))
 		for i in l:
-			data += self.encode(i)
-		return data
+			encode(i, out)
 
 	def _encodeInt(self, i):
 		if i < 0:
 			if i >= -128:
-				return struct.pack('<Bb', 0x61, i)
+				return Encoder._INT8.pack(0x61, i)
 			elif i >= -32768:
-				return struct.pack('<Bh', 0x63, i)
+				return Encoder._INT16.pack(0x63, i)
 			elif i >= -2147483648:
-				return struct.pack('<Bl', 0x65, i)
+				return Encoder._INT32.pack(0x65, i)
 			else:
-				return struct.pack('<Bq', 0x67, i)
+				return Encoder._INT64.pack(0x67, i)
 		else:
 			if i <= 0xff:
-				return struct.pack('<BB', 0x60, i)
+				return Encoder._UINT8.pack(0x60, i)
 			elif i <= 0xffff:
-				return struct.pack('<BH', 0x62, i)
+				return Encoder._UINT16.pack(0x62, i)
 			elif i <= 0xffffffff:
-				return struct.pack('<BL', 0x64, i)
+				return Encoder._UINT32.pack(0x64, i)
 			else:
-				return struct.pack('<BQ', 0x66, i)
+				return Encoder._UINT64.pack(0x66, i)
 
 
 def __decode_link(dct):
@@ -1618,9 +2827,21 @@ def __encode_link(obj):
 		raise TypeError(repr(obj) + " is not serializable")
 
 
-def loadPDSD(store, s):
+def loadPDSD(store, s, lazy=False):
+	dec = Decoder(store)
+	if lazy:
+		return dec.decodeLazy(s)
+	else:
+		return dec.decode(s)
+
+
+def iterPDSD(store, chunks, path=[]):
+	"""Decode the entries of a PDSD dict or list from an iterable of strings.
+
+	See Decoder.iterDecode() for the details.
+	"""
 	dec = Decoder(store)
-	return dec.decode(s)
+	return dec.iterDecode(chunks, path)
 
 
 def dumpPDSD(o):
@@ -0,0 +1,217 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Meta data extractors. The registry refers to them as
+# "peerdrive.extractors:<function>". Every function takes the path of a file
+# and returns a dict which is merged into the meta data of the document.
+
+from __future__ import absolute_import
+
+import os, sys, struct, threading, subprocess, email, email.utils, email.header
+
+
+###############################################################################
+# public.image
+###############################################################################
+
+def imageSize(path):
+	"""Determine the dimensions of an image from its header.
+
+	Supports JPEG, PNG, GIF, BMP and TIFF. Only the headers are read, i.e.
+	usually a few kilobytes at most. Returns (width, height) or None if the
+	format is not recognized.
+	"""
+	with open(path, 'rb') as f:
+		head = f.read(26)
+		try:
+			if head.startswith('\x89PNG\r\n\x1a\n'):
+				return struct.unpack_from('>LL', head, 16)
+			elif head[:6] in ('GIF87a', 'GIF89a'):
+				return struct.unpack_from('<HH', head, 6)
+			elif head.startswith('BM'):
+				return __bmpSize(head)
+			elif head.startswith('\xff\xd8'):
+				return __jpegSize(f)
+			elif head[:4] in ('II*\x00', 'MM\x00*'):
+				return __tiffSize(f, head)
+		except struct.error:
+			pass
+	return None
+
+def __bmpSize(head):
+	if struct.unpack_from('<L', head, 14)[0] == 12:
+		# OS/2 BITMAPCOREHEADER
+		return struct.unpack_from('<HH', head, 18)
+	else:
+		(width, height) = struct.unpack_from('<ll', head, 18)
+		return (width, abs(height))
+
+def __jpegSize(f):
+	f.seek(2)
+	while True:
+		marker = f.read(1)
+		while marker == '\xff':
+			marker = f.read(1)
+		if not marker:
+			return None
+		marker = ord(marker)
+		if (marker == 0x01) or (0xd0 <= marker <= 0xd7):
+			continue # no payload
+		(length,) = struct.unpack('>H', f.read(2))
+		if (0xc0 <= marker <= 0xcf) and (marker not in (0xc4, 0xc8, 0xcc)):
+			# start of frame: precision, height, width
+			(height, width) = struct.unpack('>xHH', f.read(5))
+			return (width, height)
+		elif marker in (0xd9, 0xda):
+			return None # end of image or scan without a frame header
+		f.seek(length - 2, 1)
+
+def __tiffSize(f, head):
+	order = '<' if head.startswith('II') else '>'
+	f.seek(struct.unpack_from(order + 'L', head, 4)[0])
+	(entries,) = struct.unpack(order + 'H', f.read(2))
+	ifd = f.read(entries * 12)
+	size = { }
+	for i in xrange(entries):
+		(tag, typ) = struct.unpack_from(order + 'HH', ifd, i*12)
+		if tag in (256, 257):
+			if typ == 3:
+				size[tag] = struct.unpack_from(order + 'H', ifd, i*12 + 8)[0]
+			elif typ == 4:
+				size[tag] = struct.unpack_from(order + 'L', ifd, i*12 + 8)[0]
+	if (256 in size) and (257 in size):
+		return (size[256], size[257])
+	return None
+
+
+def image(path):
+	size = imageSize(path)
+	if size is None:
+		# unknown format, let Qt decode the whole image
+		size = __qtImageSize(path)
+
+	return {
+		"public.image" : {
+			"width"  : size[0],
+			"height" : size[1]
+		}
+	}
+
+
+def __qtImageSize(path):
+	# QImage needs an application object which may only be created on the main
+	# thread. Library code does not create one, so decode the image in a
+	# separate process unless the application already provides it.
+	from PyQt4 import QtGui
+	if (QtGui.QApplication.instance() is not None) and \
+	   isinstance(threading.current_thread(), threading._MainThread):
+		image = QtGui.QImage()
+		image.load(path)
+		return (image.width(), image.height())
+
+	if isinstance(path, unicode):
+		path = path.encode(sys.getfilesystemencoding() or 'utf8')
+	env = os.environ.copy()
+	env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(
+		os.path.abspath(__file__)))] + filter(None, [env.get('PYTHONPATH')]))
+	if sys.platform == "win32":
+		proc = subprocess.Popen([sys.executable, '-m', 'peerdrive.extractors',
+			path], env=env, stdout=subprocess.PIPE, creationflags=0x08000000)
+	else:
+		proc = subprocess.Popen([sys.executable, '-m', 'peerdrive.extractors',
+			path], env=env, stdout=subprocess.PIPE)
+	data = proc.stdout.read()
+	if proc.wait() != 0:
+		raise IOError("Cannot decode image: " + path)
+	(width, height) = [ int(i) for i in data.split() ]
+	return (width, height)
+
+
+###############################################################################
+# message/rfc822
+###############################################################################
+
+def __decode(data, coding):
+	if coding:
+		return data.decode(coding).replace('\n', '')
+	else:
+		return data.replace('\n', '')
+
+def __decodeHeader(header):
+	return reduce(
+		lambda x,y: x + u' ' + y,
+		[ __decode(data, coding) for (data, coding) in email.header.decode_header(header) ])
+
+def __format(addr):
+	(name, dest) = addr
+	unicodeName = __decodeHeader(name)
+	return email.utils.formataddr((unicodeName, dest))
+
+def rfc822(path):
+	with open(path) as fp:
+		msg = email.message_from_file(fp)
+
+	tos = msg.get_all('to', [])
+	ccs = msg.get_all('cc', [])
+	resent_tos = msg.get_all('resent-to', [])
+	resent_ccs = msg.get_all('resent-cc', [])
+	allRecipients = email.utils.getaddresses(tos + ccs + resent_tos + resent_ccs)
+
+	# basic data
+	data = {
+		"org.peerdrive.annotation" : {
+			"title" : __decodeHeader(msg['subject']),
+			"tags" : ["unread"]
+		},
+		"public.message" : {
+			"from" : __format(email.utils.parseaddr(msg['from'])),
+			"to"   : [ __format(addr) for addr in allRecipients ],
+			"date" : long(email.utils.mktime_tz(email.utils.parsedate_tz(msg['date'])))
+		}
+	}
+
+	if msg['Message-Id']:
+		data["public.message"]["rfc822"] = {}
+		data["public.message"]["rfc822"]["id"] = msg['Message-Id']
+
+	# attachments
+	attachments = []
+	for part in msg.walk():
+		# multipart/* are just containers
+		if part.get_content_maintype() == 'multipart':
+			continue
+		name = part.get_filename()
+		if name:
+			attachments.append(name)
+
+	if attachments != []:
+		if "rfc822" not in data["public.message"]:
+			data["public.message"]["rfc822"] = {}
+		data["public.message"]["rfc822"]["attachments"] = attachments
+
+	return data
+
+
+if __name__ == '__main__':
+	# Decode an image of a format which imageSize() does not know. Used by
+	# image() when it cannot use Qt in-process.
+	from PyQt4 import QtGui
+	app = QtGui.QApplication(sys.argv, False)
+	image = QtGui.QImage()
+	image.load(sys.argv[1])
+	print image.width(), image.height()
@@ -23,7 +23,7 @@ import sys, os, subprocess, pickle, datetime, optparse
 
 from ..connector import Watch, Connector, Stat
 from ..registry import Registry
-from .. import struct, fuse, settingsPath, connector
+from .. import struct, fuse, settingsPath, connector, enableDiskCache
 from .widgets import DocumentView, DocButton
 from .utils import showProperties
 
@@ -32,6 +32,7 @@ class MainWindow(QtGui.QMainWindow, Watch):
 	def __init__(self, viewWidget, isEditor):
 		QtGui.QMainWindow.__init__(self)
 		self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+		enableDiskCache()
 
 		self.__view     = viewWidget
 		self.__isEditor = isEditor
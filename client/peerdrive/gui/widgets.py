@@ -19,11 +19,12 @@
 from __future__ import absolute_import
 
 from PyQt4 import QtCore, QtGui
-import sys, os, subprocess, pickle, datetime
+import sys, os, subprocess, pickle
 
 from ..connector import Watch, Connector
 from ..registry import Registry
 from .. import struct
+from ..history import RevisionGraph
 from .utils import showDocument, showProperties
 
 
@@ -267,6 +268,10 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 	STATE_CHOOSE_REBASE = 5
 	STATE_CHOOSE_ALTERNATE = 6
 
+	# Key of the document data in the sets of changed parts. Attachments are
+	# keyed by their names.
+	DATA = None
+
 	# checkpointNeeded: Will get True when a new checkpoint can be created,
 	# otherwise it will stay False.
 	checkpointNeeded = QtCore.pyqtSignal(bool)
@@ -443,19 +448,21 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 	def docMergeCheck(self, heads, types, changedParts):
 		# don't care about the number of heads
 		if len(types) != 1:
-			return (None, set(['META'])) # cannot merge different types
-		return (types.copy().pop(), set(['META']))
+			return (None, set([DocumentView.DATA])) # cannot merge different types
+		return (types.copy().pop(), set([DocumentView.DATA]))
 
+	# Merge the parts which were changed in both revisions. Parts which
+	# changed only on one side have already been taken care of.
+	#
 	# return conflict True/False
 	def docMergePerform(self, writer, baseReader, mergeReaders, changedParts):
-		if 'META' in changedParts:
-			baseMeta = struct.loads(self.__store, baseReader.readAll('META'))
-			mergeMeta = []
-			for mr in mergeReaders:
-				mergeMeta.append(struct.loads(self.__store, mr.readAll('META')))
-			(newMeta, conflict) = struct.merge(baseMeta, mergeMeta)
-			writer.writeAll('META', struct.dumps(newMeta))
-		return False
+		conflict = False
+		if DocumentView.DATA in changedParts:
+			baseData = baseReader.getData('')
+			mergeData = [ mr.getData('') for mr in mergeReaders ]
+			(newData, conflict) = struct.merge(baseData, mergeData)
+			writer.setData('', newData)
+		return conflict
 
 	def metaDataSetField(self, field, value):
 		item = self.__metaData
@@ -664,36 +671,15 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 
 	def __updateDocFastForward(self):
 		# find all heads which lead to current rev
-		found = []
 		target = self.__rev
 		try:
 			lookup = Connector().lookupDoc(self.__doc, [self.__store])
-			depth = Connector().stat(target).mtime() - datetime.timedelta(days=1)
 		except IOError:
 			# seems we're gone
 			self.__setState(DocumentView.STATE_CHOOSE_ALTERNATE)
 			return
-		heads = [(rev, set([rev])) for rev in lookup.revs()]
-		while heads:
-			oldHeads = heads
-			heads = []
-			for (rev, tips) in oldHeads:
-				newTips = set()
-				for tip in tips:
-					try:
-						stat = Connector().stat(tip)
-						parents = stat.parents()
-						if target in parents:
-							found.append(rev)
-							newTips = None
-							break
-						elif depth < stat.mtime():
-							newTips |= set(parents)
-					except IOError:
-						pass
-
-				if newTips:
-					heads.append((rev, newTips))
+		found = [ rev for rev in lookup.revs() if (rev != target) and
+			RevisionGraph().isAncestor(target, rev, [self.__store]) ]
 
 		if len(found) == 1:
 			# if exactly one head then just load file
@@ -855,24 +841,47 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 	def __mergeAuto(self, mergeStore, mergeRev, baseRev, rebase=False):
 		stores = [self.__store, mergeStore]
 
-		# see what has changed...
-		s = Connector().stat(baseRev, stores)
-		types = set([s.type()])
-		origParts = set(s.parts())
-		origHashes = {}
+		# See what has changed by comparing the part hashes. Parts which were
+		# changed only on one side are taken from there. Only the parts which
+		# were changed on both sides need to be read and merged.
+		(baseStat, ourStat, theirStat) = [ Connector().stat(rev, stores)
+			for rev in (baseRev, self.__rev, mergeRev) ]
+		types = set([baseStat.type(), ourStat.type(), theirStat.type()])
+		baseParts = self.__partHashes(baseStat)
+		ourParts = self.__partHashes(ourStat)
+		theirParts = self.__partHashes(theirStat)
+		ourChanges = set()
+		theirChanges = set()
 		changedParts = set()
-		for part in origParts:
-			origHashes[part] = s.hash(part)
-		for rev in [self.__rev, mergeRev]:
-			s = Connector().stat(rev, stores)
-			types.add(s.type())
-			mergeParts = set(s.parts())
-			# account for added/removed parts
-			changedParts |= mergeParts ^ origParts
-			# check for changed parts
-			for part in (mergeParts & origParts):
-				if s.hash(part) != origHashes[part]:
-					changedParts.add(part)
+		for part in set(baseParts) | set(ourParts) | set(theirParts):
+			(base, ours, theirs) = (baseParts.get(part), ourParts.get(part),
+				theirParts.get(part))
+			if ours == theirs:
+				continue
+			elif theirs == base:
+				ourChanges.add(part)
+			elif ours == base:
+				theirChanges.add(part)
+			else:
+				changedParts.add(part)
+
+		# Start from the side which changed more bytes. This is only possible
+		# for a regular merge and if their revision is available locally.
+		ourSize = sum([ self.__partSize(ourStat, p) for p in ourChanges ])
+		theirSize = sum([ self.__partSize(theirStat, p) for p in theirChanges ])
+		startTheirs = (theirSize > ourSize and not rebase and
+			not self.__preliminary and
+			self.__store in Connector().lookupRev(mergeRev, [self.__store]))
+		if startTheirs:
+			(copyParts, copyStat) = (ourChanges, ourStat)
+		else:
+			(copyParts, copyStat) = (theirChanges, theirStat)
+
+		# removed attachments cannot be copied, the application has to decide
+		for part in copyParts.copy():
+			if part not in self.__partHashes(copyStat):
+				copyParts.remove(part)
+				changedParts.add(part)
 
 		# vote
 		(uti, handledParts) = self.docMergeCheck(2, types, changedParts)
@@ -881,7 +890,6 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 		if not changedParts.issubset(handledParts):
 			return False # not all changed parts are handled
 
-		# don't use that for large documents... ;-)
 		mergeReaders = []
 		conflicts = False
 		try:
@@ -889,24 +897,38 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 			mergeReaders.append(Connector().peek(self.__store, self.__rev))
 			mergeReaders.append(Connector().peek(mergeStore, mergeRev))
 
-			if self.__preliminary:
-				updateFun = Connector().resume
+			if startTheirs:
+				writer = Connector().update(self.__store, self.__doc, mergeRev,
+					self.__creator)
+				copyReader = mergeReaders[0]
+			elif self.__preliminary:
+				writer = Connector().resume(self.__store, self.__doc,
+					self.__rev, self.__creator)
+				copyReader = mergeReaders[1]
 			else:
-				updateFun = Connector().update
-
-			with Connector().peek(Connector().lookupRev(baseRev)[0], baseRev) as baseReader:
-				with updateFun(self.__store, self.__doc, self.__rev, self.__creator) as writer:
-					writer.setType(uti)
-					conflicts = self.docMergePerform(writer, baseReader, mergeReaders, changedParts)
-					if rebase:
-						if conflicts:
-							raise AbortException
-						writer.rebase(mergeRev)
-					else:
-						writer.merge(mergeStore, mergeRev)
-					writer.suspend("<<Automatic merge>>")
-				self.__rev = writer.getRev()
-				self.__setPreliminary(True)
+				writer = Connector().update(self.__store, self.__doc,
+					self.__rev, self.__creator)
+				copyReader = mergeReaders[1]
+
+			with writer:
+				writer.setType(uti)
+				for part in copyParts:
+					self.__copyPart(copyReader, writer, part)
+				if changedParts:
+					with Connector().peek(Connector().lookupRev(baseRev)[0], baseRev) as baseReader:
+						conflicts = self.docMergePerform(writer, baseReader,
+							mergeReaders, changedParts)
+				if rebase:
+					if conflicts:
+						raise AbortException
+					writer.rebase(mergeRev)
+				elif startTheirs:
+					writer.merge(self.__store, self.__rev)
+				else:
+					writer.merge(mergeStore, mergeRev)
+				writer.suspend("<<Automatic merge>>")
+			self.__rev = writer.getRev()
+			self.__setPreliminary(True)
 		except AbortException:
 			return False
 		finally:
@@ -919,60 +941,43 @@ class DocumentView(QtGui.QStackedWidget, Watch):
 			QtGui.QMessageBox.warning(self, 'Merge conflict', 'There were merge conflicts. Please check the new version...')
 		return True
 
+	def __partHashes(self, stat):
+		hashes = dict([ (a, stat.hash(a)) for a in stat.attachments() ])
+		hashes[DocumentView.DATA] = stat.dataHash()
+		return hashes
+
+	def __partSize(self, stat, part):
+		if part == DocumentView.DATA:
+			return stat.dataSize()
+		elif part in stat.attachments():
+			return stat.size(part)
+		else:
+			return 0
+
+	def __copyPart(self, reader, writer, part):
+		# stream the part, only a few chunks are held in memory at any time
+		if part == DocumentView.DATA:
+			writer.setData('', reader.getData(''))
+		else:
+			writer.seek(part, 0)
+			writer.truncate(part)
+			for data in reader.iterRead(part):
+				writer.write(part, data)
 
-	# FIXME: This whole method is severely broken. It traverses the _whole_
-	# history and selects the merge base based on the mtime. It has also no
-	# provisions for criss-cross merges...
 	def __calculateMergeBase(self, store, mergeRev):
 		stores = [self.__store, store]
-		baseVersions = [self.__rev, mergeRev]
-		#print "Start: ", [rev.encode('hex') for rev in baseVersions]
-		heads = [[rev] for rev in baseVersions] # list of heads for each rev
-		paths = [set([rev]) for rev in baseVersions] # visited revs for each rev
-		times = { }
-
-		# traverse all paths from all baseVersions
-		addedSth = True
-		while addedSth:
-			addedSth = False
-			for i in xrange(len(heads)):
-				oldHeads = heads[i]
-				newHeads = []
-				for head in oldHeads:
-					try:
-						stat = Connector().stat(head, stores)
-						parents = stat.parents()
-						times[head] = stat.mtime()
-						for parent in parents:
-							newHeads.append(parent)
-							paths[i].add(parent)
-							addedSth = True
-					except:
-						pass
-				heads[i] = newHeads
-
-		#print "End:"
-		#for path in paths:
-		#	print "  Path: ", [rev.encode('hex') for rev in path]
-
-		# determine youngest common version
-		commonBase = reduce(lambda x, y: x&y, paths)
-		if len(commonBase) == 0:
+		bases = RevisionGraph().mergeBases(self.__rev, mergeRev, stores)
+		if len(bases) == 0:
 			return (False, None)
-		else:
-			# fast-forward merge?
-			# criteria: all base versions are in the same path
-			for i in xrange(len(baseVersions)):
-				path = paths[i]
-				all = True
-				for rev in baseVersions:
-					all = all and (rev in path)
-				if all:
-					return (True, baseVersions[i])
-
-			# normal merge
-			mergeBase = max(commonBase, key=lambda x: times[x])
-			return (False, mergeBase)
+
+		# fast-forward merge? Return the newer revision.
+		if mergeRev in bases:
+			return (True, self.__rev)
+		elif self.__rev in bases:
+			return (True, mergeRev)
+
+		# normal merge, take the youngest base of criss-cross merges
+		return (False, RevisionGraph().mergeBase(self.__rev, mergeRev, stores))
 
 
 class _ChooseWidget(QtGui.QWidget):
@@ -0,0 +1,227 @@
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+import heapq
+from datetime import datetime
+
+from .connector import Connector
+
+
+_EPOCH = datetime.fromtimestamp(0)
+
+def _timestamp(mtime):
+	# datetime cannot be negated to get a max-heap, seconds can
+	return (mtime - _EPOCH).total_seconds()
+
+
+class _RevisionGraph(object):
+	"""Index of the revision history.
+
+	Revisions are immutable, so their parents and mtime are fetched only once
+	and kept. Queries walk the history from the given revisions backwards in
+	mtime order and stop as soon as the answer is known. Thus only the part
+	where the histories diverge is visited. The parents of the whole walk
+	frontier are fetched together in one round trip.
+	"""
+
+	__LEFT = 1
+	__RIGHT = 2
+	__STALE = 4
+	__RESULT = 8
+
+	def __init__(self):
+		self.__parents = { }
+		self.__mtimes = { }
+
+	def parents(self, rev, stores=[]):
+		self.__fetch([rev], stores)
+		return self.__parents.get(rev, ())
+
+	def mergeBases(self, left, right, stores=[]):
+		"""Return the best common ancestors of two revisions.
+
+		There is more than one in case of criss-cross merges. A revision counts
+		as an ancestor of itself.
+		"""
+		bases = self.__paint(left, right, stores)
+		if len(bases) <= 1:
+			return bases
+		# remove bases which are ancestors of other bases
+		return [ base for base in bases if not any(self.isAncestor(base, other,
+			stores) for other in bases if other != base) ]
+
+	def mergeBase(self, left, right, stores=[]):
+		"""Return the youngest best common ancestor or None."""
+		bases = self.mergeBases(left, right, stores)
+		if not bases:
+			return None
+		return max(bases, key=lambda rev: self.__mtimes[rev])
+
+	def isAncestor(self, ancestor, rev, stores=[]):
+		return ancestor in self.__paint(ancestor, rev, stores)
+
+	def __paint(self, left, right, stores):
+		# Walk from both revisions to the roots, youngest revisions first. A
+		# revision reached from both sides is a common ancestor. Its ancestors
+		# are not interesting anymore ("stale"). Stop when only stale
+		# revisions are left.
+		if left == right:
+			return [left]
+		LEFT = _RevisionGraph.__LEFT
+		RIGHT = _RevisionGraph.__RIGHT
+		STALE = _RevisionGraph.__STALE
+		RESULT = _RevisionGraph.__RESULT
+		self.__fetch([left, right], stores)
+		flags = { left : LEFT, right : RIGHT }
+		queue = [ ]
+		for rev in [left, right]:
+			if rev in self.__mtimes:
+				heapq.heappush(queue, (-self.__mtimes[rev], rev))
+		result = [ ]
+		while any(not (flags[rev] & STALE) for (mtime, rev) in queue):
+			# fetch the parents of the whole frontier in one go
+			self.__fetch([ parent for (mtime, rev) in queue for parent in
+				self.__parents[rev] ], stores)
+			(mtime, rev) = heapq.heappop(queue)
+			painted = flags[rev] & (LEFT | RIGHT | STALE)
+			if painted == LEFT | RIGHT:
+				if not (flags[rev] & RESULT):
+					flags[rev] |= RESULT
+					result.append(rev)
+				painted |= STALE
+			for parent in self.__parents[rev]:
+				if (parent not in self.__mtimes) or \
+				   (flags.get(parent, 0) & painted) == painted:
+					continue
+				flags[parent] = flags.get(parent, 0) | painted
+				heapq.heappush(queue, (-self.__mtimes[parent], parent))
+		return result
+
+	def __fetch(self, revs, stores):
+		c = Connector()
+		stats = [ (rev, c.stat(rev, stores, pipelined=True)) for rev in set(revs)
+			if rev not in self.__parents ]
+		for (rev, stat) in stats:
+			try:
+				stat = stat.result()
+				self.__parents[rev] = tuple(stat.parents())
+				self.__mtimes[rev] = _timestamp(stat.mtime())
+			except IOError:
+				pass
+
+
+_graph = None
+
+def RevisionGraph():
+	global _graph
+	if not _graph:
+		_graph = _RevisionGraph()
+	return _graph
+
+
+class HistoryWalk(object):
+	"""Walk the history of revisions page by page, youngest revision first.
+
+	Every revision is returned together with its Stat and its row of the
+	revision graph, so nothing has to be fetched twice. The parents of a
+	revision are requested as soon as the revision is queued, so they are
+	usually available when the walk gets there.
+	"""
+
+	def __init__(self, heads, stores=[]):
+		self.__stores = stores
+		self.__queue = [ ]
+		self.__requested = { }
+		self.__seen = set()
+		self.__lanes = [ ]
+		self.__request(heads)
+		for rev in heads:
+			self.__enqueue(rev)
+
+	def done(self):
+		return not self.__queue
+
+	def next(self, count):
+		"""Return the next 'count' revisions as (rev, stat, row) tuples.
+
+		'row' is (column, above, below) where 'column' is the lane of the
+		revision and 'above'/'below' are the lanes entering and leaving the
+		row. Each lane is the revision it leads to or None if it is unused.
+		"""
+		result = [ ]
+		while self.__queue and len(result) < count:
+			(mtime, rev, stat) = heapq.heappop(self.__queue)
+			parents = [ parent for parent in stat.parents()
+				if self.__enqueue(parent) ]
+			result.append((rev, stat, self.__layout(rev, parents)))
+		return result
+
+	def __request(self, revs):
+		c = Connector()
+		for rev in revs:
+			if rev not in self.__requested and rev not in self.__seen:
+				self.__requested[rev] = c.stat(rev, self.__stores, pipelined=True)
+
+	def __enqueue(self, rev):
+		# Returns True if the revision exists. Its parents are requested
+		# right away but collected only when needed.
+		if rev in self.__seen:
+			return rev in self.__requested
+		self.__seen.add(rev)
+		try:
+			stat = self.__requested[rev].result()
+		except IOError:
+			del self.__requested[rev]
+			return False
+		self.__requested[rev] = None
+		heapq.heappush(self.__queue, (-_timestamp(stat.mtime()), rev, stat))
+		self.__request(stat.parents())
+		return True
+
+	def __layout(self, rev, parents):
+		return _layoutRow(self.__lanes, rev, parents)
+
+
+def _layoutRow(lanes, rev, parents):
+	# Place 'rev' in the graph and update 'lanes' for the rows below. Returns
+	# the row as described in HistoryWalk.next().
+	above = lanes[:]
+	if rev in lanes:
+		column = lanes.index(rev)
+	elif None in lanes:
+		column = lanes.index(None)
+	else:
+		column = len(lanes)
+		lanes.append(None)
+	# all lanes leading to this revision end here
+	lanes[:] = [ (None if lane == rev else lane) for lane in lanes ]
+	# the first parent continues the column, merged parents get free lanes
+	for parent in parents:
+		if parent in lanes:
+			continue
+		if lanes[column] is None:
+			lanes[column] = parent
+		elif None in lanes:
+			lanes[lanes.index(None)] = parent
+		else:
+			lanes.append(parent)
+	while lanes and lanes[-1] is None:
+		lanes.pop()
+	return (column, above, lanes[:])
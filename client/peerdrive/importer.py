@@ -18,10 +18,10 @@
 
 from __future__ import absolute_import
 
-import os, sys, subprocess
+import os, re, sys, subprocess, threading, Queue, multiprocessing
 
 from . import struct, connector
-from .connector import Connector
+from .connector import Connector, BulkConnector
 from .registry import Registry
 
 try:
@@ -31,13 +31,24 @@ try:
 except ImportError:
 	mimeGuess = None
 
+# libmagic handles must not be used concurrently
+mimeLock = threading.Lock()
+
 
 class ImporterError(Exception):
     """Base class for exceptions in this module."""
     pass
 
 
+_plugins = { }
+_pluginLock = threading.Lock()
+_pluginRe = re.compile(r'^[\w.]+:\w+$')
+
 def __runExtractor(extractor, path):
+	# Extractors are either a Python callable ("package.module:function")
+	# which is run in-process or an executable script.
+	if _pluginRe.match(extractor):
+		return __runPlugin(extractor, path)
 	if sys.platform == "win32":
 		proc = subprocess.Popen([extractor, path], shell=True,
 			stdout=subprocess.PIPE, creationflags=0x08000000)
@@ -48,6 +59,18 @@ def __runExtractor(extractor, path):
 	return connector.loadJSON(data)
 
 
+def __runPlugin(extractor, path):
+	with _pluginLock:
+		if extractor not in _plugins:
+			(module, function) = extractor.split(':')
+			module = __import__(module, fromlist=[function])
+			_plugins[extractor] = getattr(module, function)
+		plugin = _plugins[extractor]
+	if isinstance(path, str):
+		path = path.decode(sys.getfilesystemencoding() or 'utf8')
+	return plugin(path)
+
+
 def __merge(old, new):
 	for (key, newValue) in new.items():
 		if key in old:
@@ -64,63 +87,351 @@ def __merge(old, new):
 			old[key] = newValue
 
 
+def _detect(path, name):
+	# Determine the type and meta data of a file. Does not talk to the server,
+	# so it may run in any thread.
+	uti = None
+	if mimeGuess:
+		with mimeLock:
+			mime = mimeGuess.file(path)
+		uti = Registry().getUtiFromMime(mime, None)
+	if not uti:
+		ext  = os.path.splitext(path)[1].lower()
+		uti  = Registry().getUtiFromExtension(ext)
+	meta = {
+		"org.peerdrive.annotation" : {
+			"title"   : name,
+			"origin"  : path
+		}
+	}
+
+	extractor = Registry().getExtractor(uti)
+	if extractor:
+		additionalMeta = __runExtractor(extractor, path)
+		if additionalMeta:
+			__merge(meta, additionalMeta)
+
+	return (uti, meta)
+
+
+def _upload(store, path, uti, meta, connection=None):
+	with open(path, "rb") as file:
+		writer = (connection or BulkConnector()).create(store, uti, "")
+		try:
+			writer.setData('', meta)
+			writer.writeFrom('_', file)
+			writer.commit("Import from external file system")
+			return writer
+		except:
+			writer.close()
+			raise
+
+
 # returns a commited writer, None or throws an IOError
-def importFile(store, path, name="", progress=None):
+def importFile(store, path, name="", progress=None, errors=None):
 	if not name:
 		name = os.path.basename(path)
 
 	if os.path.isfile(path):
 		if progress:
 			progress(path)
+		(uti, meta) = _detect(path, name)
+		return _upload(store, path, uti, meta)
+	elif os.path.isdir(path):
+		return importTree(store, path, name, progress, errors=errors)
+	else:
+		return None
 
-		# determine file type
-		uti = None
-		if mimeGuess:
-			mime = mimeGuess.file(path)
-			uti = Registry().getUtiFromMime(mime, None)
-		if not uti:
-			ext  = os.path.splitext(path)[1].lower()
-			uti  = Registry().getUtiFromExtension(ext)
-		meta = {
-			"org.peerdrive.annotation" : {
-				"title"   : name,
-				"origin"  : path
-			}
-		}
-
-		extractor = Registry().getExtractor(uti)
-		if extractor:
-			additionalMeta = __runExtractor(extractor, path)
-			if additionalMeta:
-				__merge(meta, additionalMeta)
 
-		with open(path, "rb") as file:
-			writer = Connector().create(store, uti, "")
+class _Upload(object):
+	# Pending upload of a file or creation of a folder. 'doc' is set when it
+	# is done, 'error' if it failed. The committed 'handle' stays open until
+	# the parent folder links the document, otherwise the server would collect
+	# it. It is closed through 'closer', the close queue of the uploader thread
+	# which owns the connection, or directly if 'closer' is None.
+	def __init__(self, path, title, uti=None, meta=None):
+		self.path = path
+		self.title = title
+		self.uti = uti
+		self.meta = meta
+		self.doc = None
+		self.error = None
+		self.handle = None
+		self.closer = None
+		self.__done = threading.Event()
+
+	def finish(self, doc, error=None):
+		self.doc = doc
+		self.error = error
+		self.__done.set()
+
+	def wait(self):
+		while not self.__done.wait(1):
+			pass
+		return self.doc
+
+	def close(self):
+		if self.handle:
+			if self.closer:
+				self.closer.put(self.handle)
+			else:
+				self.handle.close()
+			self.handle = None
+
+
+class _TreeImporter(object):
+	"""Import a directory tree with pools of worker and uploader threads.
+
+	A walker thread enumerates the tree. The workers determine the type and
+	run the extractors of the files. The uploaders write the files to the
+	server concurrently, each on a connection of its own. The calling thread
+	handles the entries in the order of the walk and creates the folders as
+	soon as their entries are uploaded. At most MAX_PENDING entries are in
+	flight between the walker and the calling thread, and as many files wait
+	for the uploaders.
+
+	Files and directories which cannot be imported are left out and reported
+	in 'errors' as (path, exception) tuples.
+	"""
+	MAX_PENDING = 64
+
+	ENTER = 0
+	FILE = 1
+	LEAVE = 2
+	ERROR = 3
+	END = 4
+
+	def __init__(self, workers, uploaders, errors):
+		self.__jobs = Queue.Queue()
+		self.__uploads = Queue.Queue(_TreeImporter.MAX_PENDING)
+		self.__results = { }
+		self.__done = threading.Condition()
+		self.__slots = threading.Semaphore(_TreeImporter.MAX_PENDING)
+		self.__abort = False
+		self.__workers = workers
+		self.__uploaders = uploaders
+		self.__errors = errors
+
+	def run(self, store, path, name, progress):
+		Registry() # load it before the workers access it
+		address = Connector().address
+		threads = [ threading.Thread(target=self.__work) for i in
+			xrange(self.__workers) ]
+		threads.extend([ threading.Thread(target=self.__upload,
+			args=(store, address)) for i in xrange(self.__uploaders) ])
+		threads.append(threading.Thread(target=self.__walk, args=(path, name)))
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		try:
+			return self.__collect(store, progress)
+		finally:
+			# let the walker, the workers and the uploaders run out
+			self.__abort = True
+			for i in xrange(_TreeImporter.MAX_PENDING + 1):
+				self.__slots.release()
+			for i in xrange(self.__workers):
+				self.__jobs.put(None)
+			for i in xrange(self.__uploaders):
+				self.__uploads.put(None)
+
+	def __walk(self, path, name):
+		# emit the tree in the same order as a recursive importFile()
+		seq = 0
+		stack = [(path, name)]
+		try:
+			while stack and not self.__abort:
+				item = stack.pop()
+				if item is None:
+					job = (_TreeImporter.LEAVE, None, None)
+				else:
+					(path, name) = item
+					if os.path.isfile(path):
+						job = (_TreeImporter.FILE, path, name)
+					elif os.path.isdir(path):
+						try:
+							entries = os.listdir(path)
+						except OSError as e:
+							self.__put(seq, (_TreeImporter.ERROR, path, e))
+							seq += 1
+							continue
+						job = (_TreeImporter.ENTER, path, name)
+						stack.append(None)
+						stack.extend(reversed([ (os.path.join(path, entry), entry)
+							for entry in entries ]))
+					else:
+						continue
+				self.__put(seq, job)
+				seq += 1
+			job = (_TreeImporter.END, None, None)
+		except Exception as e:
+			job = (_TreeImporter.ERROR, None, e)
+		self.__put(seq, job)
+
+	def __put(self, seq, job):
+		self.__slots.acquire()
+		self.__jobs.put((seq,) + job)
+
+	def __work(self):
+		while True:
+			job = self.__jobs.get()
+			if job is None:
+				break
+			(seq, kind, path, name) = job
+			if (kind == _TreeImporter.FILE) and not self.__abort:
+				try:
+					result = (kind, path, _detect(path, name))
+				except Exception as e:
+					result = (_TreeImporter.ERROR, path, e)
+			else:
+				result = (kind, path, name)
+			with self.__done:
+				self.__results[seq] = result
+				self.__done.notify_all()
+
+	def __upload(self, store, address):
+		# The connection is opened here, the transport must only be used by
+		# the thread which created it. Qt sockets need an event loop which
+		# this thread does not have, so use a plain socket.
+		try:
+			connection = connector._Connector(address, qt=False)
+			error = None
+		except IOError as e:
+			connection = None
+			error = e
+		closing = Queue.Queue()
+		try:
+			while True:
+				upload = self.__uploads.get()
+				self.__closeLinked(closing)
+				if upload is None:
+					break
+				if self.__abort:
+					upload.finish(None, IOError("Import aborted"))
+					continue
+				try:
+					if connection is None:
+						raise error
+					upload.handle = _upload(store, upload.path, upload.uti,
+						upload.meta, connection)
+					upload.closer = closing
+					upload.finish(upload.handle.getDoc())
+				except Exception as e:
+					upload.finish(None, e)
+		finally:
+			if connection:
+				self.__closeLinked(closing)
+				connection.transport.close()
+
+	@staticmethod
+	def __closeLinked(closing):
+		# close the handles of files which are linked by their folder by now
+		while True:
 			try:
-				writer.setData('', meta)
-				writer.write('_', file.read())
-				writer.commit("Import from external file system")
-				return writer
-			except:
-				writer.close()
-				raise
-	elif os.path.isdir(path):
-		handles = []
+				handle = closing.get_nowait()
+			except Queue.Empty:
+				break
+			try:
+				handle.close()
+			except IOError:
+				pass
+
+	def __next(self, seq):
+		with self.__done:
+			while seq not in self.__results:
+				self.__done.wait(1)
+			result = self.__results.pop(seq)
+		self.__slots.release()
+		return result
+
+	def __collect(self, store, progress):
+		seq = 0
+		stack = [ (None, None, []) ] # (path, folder name, uploads of its entries)
+		try:
+			while True:
+				(kind, path, result) = self.__next(seq)
+				seq += 1
+				if kind == _TreeImporter.FILE:
+					if progress:
+						progress(path)
+					(uti, meta) = result
+					title = meta["org.peerdrive.annotation"].get("title",
+						os.path.basename(path))
+					upload = _Upload(path, title, uti, meta)
+					self.__uploads.put(upload)
+					stack[-1][2].append(upload)
+				elif kind == _TreeImporter.ENTER:
+					stack.append((path, result, []))
+				elif kind == _TreeImporter.LEAVE:
+					(path, name, uploads) = stack.pop()
+					folder = self.__createFolder(store, path, name, uploads)
+					stack[-1][2].append(folder)
+				elif kind == _TreeImporter.ERROR:
+					if path is None:
+						raise result
+					self.__failed(path, result)
+				else:
+					break
+		except:
+			for (path, name, uploads) in stack:
+				for upload in uploads:
+					upload.close()
+			raise
+		uploads = stack.pop()[2]
+		return uploads[0].handle if uploads else None
+
+	def __createFolder(self, store, path, name, uploads):
+		# The titles are known already, so the entries are linked without
+		# asking the server. The handles of the entries are closed once the
+		# folder is committed. The handle of the top level folder is returned
+		# to the caller.
+		folder = struct.Folder()
+		for upload in uploads:
+			doc = upload.wait()
+			if doc:
+				folder.append(connector.DocLink(store, doc, False), upload.title)
+			elif upload.error:
+				self.__failed(upload.path, upload.error)
+		result = _Upload(path, name)
 		try:
-			for entry in os.listdir(path):
-				handle = importFile(store, os.path.join(path, entry), entry, progress)
-				handles.append(handle)
+			result.handle = folder.create(store, name)
+			result.finish(result.handle.getDoc())
+		except IOError as e:
+			result.finish(None, e)
+		finally:
+			for upload in uploads:
+				upload.close()
+		return result
 
-			folder = struct.Folder()
-			for handle in handles:
-				folder.append(connector.DocLink(store, handle.getDoc()))
+	def __failed(self, path, error):
+		self.__errors.append((path, error))
 
-			return folder.create(store, name)
-		finally:
-			for handle in handles:
-				handle.close()
-	else:
-		return None
+
+def importTree(store, path, name="", progress=None, workers=None, errors=None):
+	"""Import a directory tree like importFile(), but in parallel.
+
+	Type detection and meta data extraction run in 'workers' threads, one per
+	CPU by default. The files are uploaded by BULK_CONNECTIONS threads.
+	Entries which fail are left out and appended to the 'errors' list as
+	(path, exception). Without an 'errors' list the first failure is raised
+	after the import. Returns the commited writer of the top level folder.
+	"""
+	if not name:
+		name = os.path.basename(path)
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if errors is not None:
+		return _TreeImporter(workers, connector.BULK_CONNECTIONS, errors).run(
+			store, path, name, progress)
+
+	errors = []
+	handle = _TreeImporter(workers, connector.BULK_CONNECTIONS, errors).run(
+		store, path, name, progress)
+	if errors:
+		if handle:
+			handle.close()
+		raise errors[0][1]
+	return handle
 
 
 def overwriteFile(link, path):
@@ -142,7 +453,7 @@ def overwriteFile(link, path):
 	rev = link.rev()
 	if not (doc and rev):
 		return False
-	with Connector().update(store, doc, rev) as writer:
+	with BulkConnector().update(store, doc, rev) as writer:
 		meta = writer.getData('')
 		meta["org.peerdrive.annotation"]["origin"] = path
 
@@ -153,7 +464,9 @@ def overwriteFile(link, path):
 				__merge(meta, additionalMeta)
 
 		with open(path, "rb") as file:
-			writer.writeAll('_', file.read())
+			writer.seek('_', 0)
+			writer.truncate('_')
+			writer.writeFrom('_', file)
 		writer.setData('', meta)
 		writer.setType(uti)
 		writer.commit("Overwritten from external file system")
@@ -225,7 +538,8 @@ def importObjectByPath(path, uti, data, spec, overwrite=False, flags=[]):
 		return False
 
 
-def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=None):
+def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=None,
+                     errors=None):
 	# resolve the path
 	(store, folder, name) = struct.walkPath(impPath, True)
 
@@ -241,7 +555,7 @@ def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=Non
 					nn = "%s%d" % (name, counter)
 				if progress:
 					progress(f, nn)
-				handle = importFile(store, f)
+				handle = importFile(store, f, errors=errors)
 				if handle:
 					handles.append(handle)
 					folder[nn] = connector.DocLink(store, handle.getDoc())
@@ -255,7 +569,7 @@ def importFileByPath(impPath, impFile, overwrite=False, progress=None, error=Non
 		if (name in folder) and (not overwrite):
 			raise ImporterError("Duplicate item name")
 
-		handle = importFile(store, impFile, name)
+		handle = importFile(store, impFile, name, errors=errors)
 		try:
 			if handle:
 				folder[name] = connector.DocLink(store, handle.getDoc())
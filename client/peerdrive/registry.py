@@ -37,7 +37,23 @@ class _Registry(connector.Watch):
 	def loadRegistry(self):
 		self.__regLink.update()
 		with self.connection.peek(self.__regLink.store(), self.__regLink.rev()) as r:
-			self.registry = r.getData('/org.peerdrive.registry')
+			self._setRegistry(r.getData('/org.peerdrive.registry'))
+
+	def _setRegistry(self, registry):
+		# The first UTI in the registry wins if an extension or mime type is
+		# claimed more than once.
+		self.registry = registry
+		self.__extensions = { }
+		self.__mimeTypes = { }
+		for (uti, spec) in self.registry.items():
+			for ext in spec.get("extensions", []):
+				self.__extensions.setdefault(ext, uti)
+			for mime in spec.get("mimetypes", []):
+				self.__mimeTypes.setdefault(mime, uti)
+		self.__closures = { }
+		self.__searches = { }
+		self.__searchAlls = { }
+		self.__executables = { }
 
 	def triggered(self, event, store):
 		if event == connector.Watch.EVENT_MODIFIED:
@@ -56,79 +72,96 @@ class _Registry(connector.Watch):
 		return reduce(lambda x,y: x+y, self.searchAll(uti, "meta").values(), [])
 
 	def getUtiFromExtension(self, ext, default = "public.data"):
-		for (uti, spec) in self.registry.items():
-			if "extensions" in spec:
-				if ext in spec["extensions"]:
-					return uti
-		return default
+		return self.__extensions.get(ext, default)
 
 	def getUtiFromMime(self, mime, default = "public.data"):
 		mime = mime.split(';')[0].strip()
 		# maybe support mime parameters too?
-		for (uti, spec) in self.registry.items():
-			if "mimetypes" in spec:
-				if mime in spec["mimetypes"]:
-					return uti
-		return default
+		return self.__mimeTypes.get(mime, default)
 
 	def getExtractor(self, uti):
 		return self.search(uti, "extractor")
 
 	def getExecutables(self, uti):
-		preliminary = self.__getExecutables(uti)
-		# remove duplicate items
-		result = []
-		for i in preliminary:
-			if i not in result:
-				result.append(i)
-		return result
+		if uti not in self.__executables:
+			# remove duplicate items
+			result = []
+			for i in self.__getExecutables(uti):
+				if i not in result:
+					result.append(i)
+			self.__executables[uti] = result
+		return self.__executables[uti][:]
 
 	def conformes(self, uti, superClass):
-		if uti == superClass:
-			return True
-		result = False
+		return (uti == superClass) or (superClass in self.__closure(uti))
+
+	def __closure(self, uti):
+		# set of 'uti' and all UTIs it conforms to, directly or indirectly
+		if uti not in self.__closures:
+			closure = set()
+			todo = [uti]
+			while todo:
+				i = todo.pop()
+				if i not in closure:
+					closure.add(i)
+					todo.extend(self.registry.get(i, {}).get("conforming", []))
+			self.__closures[uti] = closure
+		return self.__closures[uti]
+
+	def __getExecutables(self, uti, visited=None):
+		if visited is None:
+			visited = set()
+		if uti in visited:
+			return []
+		visited.add(uti)
 		item = self.registry.get(uti, {})
+		data = list(item.get("exec", []))
 		for i in item.get("conforming", []):
-			result = result or self.conformes(i, superClass)
-		return result
-
-	def __getExecutables(self, uti):
-		item = self.registry.get(uti, {})
-		data = item.get("exec", [])
-		for i in item.get("conforming", []):
-			data.extend(self.__getExecutables(i))
+			data.extend(self.__getExecutables(i, visited))
 		return data
 
+	__NOT_FOUND = object()
+
 	def search(self, uti, key, recursive=True, default=None):
-		if uti not in self.registry:
+		memo = (uti, key, recursive)
+		if memo not in self.__searches:
+			self.__searches[memo] = self.__search(uti, key, recursive, set())
+		result = self.__searches[memo]
+		if result is _Registry.__NOT_FOUND:
 			return default
+		return result
 
+	def __search(self, uti, key, recursive, visited):
+		if (uti not in self.registry) or (uti in visited):
+			return _Registry.__NOT_FOUND
+		visited.add(uti)
 		item = self.registry[uti]
 		if key in item:
 			return item[key]
-		elif not recursive:
-			return default
-		elif "conforming" not in item:
-			return default
-		else:
-			for i in item["conforming"]:
-				data = self.search(i, key)
-				if not (data is None):
+		elif recursive:
+			for i in item.get("conforming", []):
+				data = self.__search(i, key, True, visited)
+				if data is not _Registry.__NOT_FOUND and data is not None:
 					return data
-			return default
+		return _Registry.__NOT_FOUND
 
 	def searchAll(self, uti, key):
-		if uti not in self.registry:
-			return {}
+		memo = (uti, key)
+		if memo not in self.__searchAlls:
+			self.__searchAlls[memo] = self.__searchAll(uti, key, set())
+		return self.__searchAlls[memo].copy()
 
+	def __searchAll(self, uti, key, visited):
+		if (uti not in self.registry) or (uti in visited):
+			return {}
+		visited.add(uti)
 		item = self.registry[uti]
 		if key in item:
 			data = { uti : item[key] }
 		else:
 			data = {}
-		if "conforming" in item:
-			for i in item["conforming"]:
-				data.update(self.searchAll(i, key))
+		for i in item.get("conforming", []):
+			data.update(self.__searchAll(i, key, visited))
 		return data
 
 
@@ -18,7 +18,7 @@
 
 from __future__ import absolute_import
 
-import struct, copy
+import struct, copy, collections
 
 from . import connector
 
@@ -101,27 +101,49 @@ def __mergeDict(base, versions):
 	return (newDict, conflict)
 
 
+def _mergeKey(item):
+	"""Return a hashable key which compares like the item itself.
+
+	Dicts and lists are frozen recursively. Lists and tuples get distinct
+	keys because they never compare equal either.
+	"""
+	t = type(item)
+	if t is dict or t is connector.LazyDict:
+		return (dict, frozenset([(k, _mergeKey(v)) for (k, v) in item.iteritems()]))
+	elif t is list or t is connector.LazyList:
+		return (list, tuple([_mergeKey(i) for i in item]))
+	elif t is tuple:
+		return (tuple, tuple([_mergeKey(i) for i in item]))
+	else:
+		return item
+
+
 def __mergeList(base, versions):
+	# Removed items are taken out of the base (first occurrence only) while
+	# added items are appended in the order they are found in the versions.
+	baseKeys = [_mergeKey(item) for item in base]
+	baseSet = set(baseKeys)
+	removed = set()
 	added   = []
-	removed = []
+	addedSet = set()
 	for ver in versions:
+		verKeys = [_mergeKey(item) for item in ver]
 		# check for removed items
-		for item in base:
-			if item not in ver:
-				if item not in removed:
-					removed.append(item)
+		removed.update(baseSet.difference(verKeys))
 		# check for added items
-		for item in ver:
-			if item not in base:
-				if item not in added:
-					added.append(item)
+		for (key, item) in zip(verKeys, ver):
+			if key not in baseSet and key not in addedSet:
+				addedSet.add(key)
+				added.append(item)
 
 	# apply diff
-	newList = base[:]
-	for item in removed:
-		newList.remove(item)
-	for item in added:
-		newList.append(item)
+	newList = []
+	for (key, item) in zip(baseKeys, base):
+		if key in removed:
+			removed.remove(key)
+		else:
+			newList.append(item)
+	newList.extend(added)
 	return (newList, False)
 
 
@@ -134,6 +156,7 @@ class Folder(object):
 
 	def __init__(self, link = None):
 		self.__didCache = False
+		self.__names = None # title -> index of first entry
 		if link:
 			link.update()
 			self.__rev = link.rev()
@@ -149,18 +172,25 @@ class Folder(object):
 	def __load(self):
 		if not self.__rev:
 			raise IOError("Folder not found")
-		uti = connector.Connector().stat(self.__rev, [self.__store]).type()
-		if uti not in Folder.UTIs:
-			raise IOError("Not a folder: "+uti)
-		with connector.Connector().peek(self.__store, self.__rev) as r:
-			self.__meta = r.getData('/org.peerdrive.annotation')
-			content = r.getData('/org.peerdrive.folder')
+		stat = connector.Connector().stat(self.__rev, [self.__store], pipelined=True)
+		handle = connector.Connector().peek(self.__store, self.__rev, pipelined=True)
+		with handle.result() as r:
+			uti = stat.result().type()
+			if uti not in Folder.UTIs:
+				raise IOError("Not a folder: "+uti)
+			meta = r.getData('/org.peerdrive.annotation', pipelined=True)
+			content = r.getData('/org.peerdrive.folder', pipelined=True)
+			self.__meta = meta.result()
+			content = content.result()
 		self.__content = [ (None, l) for l in content ]
+		self.__names = None
 
 	def __doCache(self):
 		if not self.__didCache:
-			self.__content = [ (readTitle(i['']), i) for (t, i) in
-				self.__content ]
+			titles = readTitles([ i[''] for (t, i) in self.__content ])
+			self.__content = [ (title, i) for (title, (t, i)) in
+				zip(titles, self.__content) ]
+			self.__names = None
 			self.__didCache = True
 
 	def create(self, store, name=None):
@@ -172,7 +202,8 @@ class Folder(object):
 			name = "New folder"
 		self.__meta = { "title" : name }
 		for (descr, item) in self.__content:
-			item[''].update(self.__store)
+			if item[''].store() != self.__store:
+				item[''].update(self.__store)
 		content = [ item for (descr, item) in self.__content ]
 		w = connector.Connector().create(store, "org.peerdrive.folder", "")
 		try:
@@ -207,16 +238,15 @@ class Folder(object):
 		return "Unnamed folder"
 
 	def __index(self, title, fail=True):
-		i = 0
-		for (key, item) in self.__content:
-			if key == title:
-				return i
-			else:
-				i += 1
-		if fail:
+		if self.__names is None:
+			names = { }
+			for (i, (key, item)) in enumerate(self.__content):
+				names.setdefault(key, i)
+			self.__names = names
+		i = self.__names.get(title)
+		if (i is None) and fail:
 			raise IndexError(title)
-		else:
-			return None
+		return i
 
 	def __len__(self):
 		return len(self.__content)
@@ -227,21 +257,26 @@ class Folder(object):
 			i = self.__index(i)
 		return self.__content[i][1]['']
 
-	def __delitem__(self, select):
+	def __delitem__(self, i):
 		if isinstance(i, basestring):
 			self.__doCache()
 			i = self.__index(i)
 		del self.__content[i]
+		self.__names = None
 
 	def __contains__(self, name):
 		self.__doCache()
 		i = self.__index(name, False)
 		return i is not None
 
-	def append(self, link):
+	def append(self, link, title=None):
 		if self.__store:
 			link.update(self.__store)
-		self.__content.append( (readTitle(link), { '' : link }) )
+		if title is None:
+			title = readTitle(link)
+		self.__content.append( (title, { '' : link }) )
+		if self.__names is not None:
+			self.__names.setdefault(title, len(self.__content) - 1)
 
 	def get(self, name):
 		self.__doCache()
@@ -258,6 +293,7 @@ class Folder(object):
 	def remove(self, name, link):
 		self.__doCache()
 		self.__content.remove((name, {'' : link}))
+		self.__names = None
 
 	def getDoc(self):
 		return self.__doc
@@ -265,17 +301,43 @@ class Folder(object):
 	def getRev(self):
 		return self.__rev
 
-# tiny helper function
+# tiny helper functions
 def readTitle(link, default=None):
-	rev = link.rev()
-	if rev:
-		try:
-			with connector.Connector().peek(link.store(), rev) as r:
-				return r.getData("/org.peerdrive.annotation/title")
-		except IOError:
-			pass
+	return readTitles([link], default)[0]
+
+
+# maximum number of documents which readTitles() opens at the same time
+READ_TITLES_WINDOW = 64
 
-	return default
+def readTitles(links, default=None):
+	titles = [default] * len(links)
+	connector.pipeline(( __readTitleSteps(link, titles, i) for (i, link)
+		in enumerate(links) ), READ_TITLES_WINDOW)
+	return titles
+
+
+def __readTitleSteps(link, titles, i):
+	try:
+		if isinstance(link, connector.DocLink) and not link.updated():
+			lookup = connector.Connector().lookupDoc(link.doc(), [link.store()],
+				pipelined=True)
+			yield
+			link.update(lookup=lookup.result())
+		rev = link.rev()
+		if not rev:
+			return
+		handle = connector.Connector().peek(link.store(), rev, pipelined=True)
+		yield
+		r = handle.result()
+		title = r.getData("/org.peerdrive.annotation/title", pipelined=True)
+		closing = r.close(pipelined=True)
+		yield
+		try:
+			titles[i] = title.result()
+		finally:
+			closing.result()
+	except IOError:
+		pass
 
 
 class FSTab(object):
@@ -331,6 +393,13 @@ def walkPath(path, create=False):
 	docName = steps[-1]
 	steps = steps[1:-1]
 
+	# Paths starting with a store label are resolved without enumerating the
+	# stores first.
+	try:
+		return __walkServer(storeName, steps, docName)
+	except IOError:
+		pass
+
 	# search for store
 	enum = connector.Connector().enum()
 	storeDoc = None
@@ -342,6 +411,17 @@ def walkPath(path, create=False):
 	if not storeDoc:
 		raise IOError("Store not found")
 
+	# Let the server walk the path in one round trip. Walk it here only if
+	# folders have to be created on the way.
+	if steps and mount.label:
+		if mount.label != storeName:
+			try:
+				return __walkServer(mount.label, steps, docName)
+			except IOError:
+				pass
+		if not create:
+			raise IOError("Path not found")
+
 	# walk the path
 	curFolder = Folder(connector.DocLink(storeDoc, storeDoc, False))
 	for step in steps:
@@ -364,6 +444,13 @@ def walkPath(path, create=False):
 	return (storeDoc, curFolder, docName)
 
 
+def __walkServer(label, steps, docName):
+	items = connector.PathCache().walkPath(label + ':' + '/'.join(steps))
+	for (store, doc) in items:
+		return (store, Folder(connector.DocLink(store, doc)), docName)
+	raise IOError("Path not found")
+
+
 def copyDoc(src, dstStore):
 	src.update()
 	if not src.rev():
@@ -18,9 +18,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from PyQt4 import QtCore, QtGui
-from peerdrive import Connector, Registry, struct, connector
+from peerdrive import Connector, Registry, struct, connector, enableDiskCache
 from peerdrive.gui.widgets import DocButton, RevButton
 from peerdrive.gui.utils import showDocument
+from peerdrive.history import HistoryWalk
 
 def extractMetaData(metaData, path, default):
 	item = metaData
@@ -230,19 +231,83 @@ class RevisionTab(QtGui.QWidget):
 
 class HistoryTab(QtGui.QWidget):
 
-	# TODO: implement something nice gitk like...
+	class GraphDelegate(QtGui.QStyledItemDelegate):
+		LANE_WIDTH = 12
+		DOT_SIZE = 6
+
+		def __init__(self, historyList):
+			super(HistoryTab.GraphDelegate, self).__init__(historyList)
+			self.__list = historyList
+
+		def paint(self, painter, option, index):
+			(column, above, below) = self.__list.graphRow(index.row())
+			width = HistoryTab.GraphDelegate.LANE_WIDTH
+			rect = option.rect
+			x = lambda lane: rect.left() + lane*width + width/2
+			top = rect.top()
+			mid = rect.top() + rect.height()/2
+			bottom = rect.bottom() + 1
+			lanes = max(len(above), len(below), column+1)
+
+			painter.save()
+			painter.setRenderHint(QtGui.QPainter.Antialiasing)
+			painter.setPen(QtGui.QPen(option.palette.text(), 1.5))
+			rev = self.__list.rev(index.row())
+			for (i, lane) in enumerate(above):
+				if lane == rev:
+					painter.drawLine(x(i), top, x(column), mid)
+				elif lane is not None:
+					painter.drawLine(x(i), top, x(i), bottom)
+			for parent in self.__list.graphParents(index.row()):
+				if parent in below:
+					painter.drawLine(x(column), mid, x(below.index(parent)), bottom)
+			painter.setBrush(option.palette.text())
+			dot = HistoryTab.GraphDelegate.DOT_SIZE
+			painter.drawEllipse(QtCore.QPointF(x(column), mid), dot/2, dot/2)
+			painter.restore()
+
+			textOption = QtGui.QStyleOptionViewItemV4(option)
+			textOption.rect = rect.adjusted(lanes*width, 0, 0, 0)
+			super(HistoryTab.GraphDelegate, self).paint(painter, textOption, index)
+
 	class HistoryList(QtGui.QListWidget):
+		# revisions fetched at once when the end of the list comes into view
+		PAGE_SIZE = 50
+
 		def __init__(self, parent=None):
 			super(HistoryTab.HistoryList, self).__init__(parent)
 			self.__revs = []
+			self.__rows = []
+			self.__walk = None
+			self.setItemDelegate(HistoryTab.GraphDelegate(self))
 			self.itemDoubleClicked.connect(self.__open)
+			self.verticalScrollBar().valueChanged.connect(self.__fetchMore)
 			self.setDragEnabled(True)
 
-		def setRevs(self, store, revs):
+		def setHistory(self, store, walk):
 			self.__store = store
-			self.__revs = revs[:]
+			self.__walk = walk
+			self.__revs = []
+			self.__rows = []
 			self.clear()
-			self.insertItems(0, [self.__loadComment(rev) for rev in revs])
+			self.__fetchMore()
+
+		def rev(self, row):
+			return self.__revs[row]
+
+		def graphRow(self, row):
+			return self.__rows[row][0]
+
+		def graphParents(self, row):
+			return self.__rows[row][1]
+
+		def showEvent(self, event):
+			super(HistoryTab.HistoryList, self).showEvent(event)
+			self.__fetchMore()
+
+		def resizeEvent(self, event):
+			super(HistoryTab.HistoryList, self).resizeEvent(event)
+			self.__fetchMore()
 
 		def supportedDropActions(self):
 			return QtCore.Qt.IgnoreAction
@@ -262,17 +327,28 @@ class HistoryTab(QtGui.QWidget):
 			connector.dumpMimeData(mimeData, links)
 			return mimeData
 
-		def __loadComment(self, rev):
-			try:
-				stat = Connector().stat(rev, [self.__store])
-				mtime = str(stat.mtime())
-				comment = stat.comment()
-				if comment:
-					return mtime + " - " + comment
-				else:
-					return mtime
-			except IOError:
-				return "???"
+		def __fetchMore(self, value=None):
+			# Load the next page when less than one screen is left below the
+			# visible items. Check again once the new items are laid out.
+			if not self.__walk or self.__walk.done() or not self.isVisible():
+				return
+			bar = self.verticalScrollBar()
+			if bar.maximum() - bar.value() > bar.pageStep():
+				return
+			page = self.__walk.next(HistoryTab.HistoryList.PAGE_SIZE)
+			for (rev, stat, row) in page:
+				self.__revs.append(rev)
+				self.__rows.append((row, stat.parents()))
+				self.addItem(self.__getLabel(stat))
+			QtCore.QTimer.singleShot(0, self.__fetchMore)
+
+		def __getLabel(self, stat):
+			mtime = str(stat.mtime())
+			comment = stat.comment()
+			if comment:
+				return mtime + " - " + comment
+			else:
+				return mtime
 
 		def __open(self, item):
 			row = self.row(item)
@@ -293,20 +369,7 @@ class HistoryTab(QtGui.QWidget):
 		self.setLayout(layout)
 
 	def load(self, store, rev):
-		revs = []
-		heads = [rev]
-		while len(heads) > 0:
-			newHeads = []
-			for rev in heads:
-				try:
-					if rev not in revs:
-						revs.append(rev)
-						newHeads.extend(Connector().stat(rev, [store]).parents())
-				except IOError:
-					pass
-			heads = newHeads
-
-		self.__historyListBox.setRevs(store, revs)
+		self.__historyListBox.setHistory(store, HistoryWalk([rev], [store]))
 
 
 class AnnotationTab(QtGui.QWidget):
@@ -385,6 +448,7 @@ if __name__ == '__main__':
 	import sys
 
 	app = QtGui.QApplication(sys.argv)
+	enableDiskCache()
 
 	link = None
 	if len(sys.argv) == 2:
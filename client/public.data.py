@@ -69,7 +69,8 @@ if not path:
 	if not os.path.isfile(path):
 		with open(path, "wb") as file:
 			with Connector().peek(link.store(), link.rev()) as reader:
-				file.write(reader.readAll('_'))
+				for chunk in reader.iterRead('_'):
+					file.write(chunk)
 		os.chmod(path, stat.S_IREAD)
 
 
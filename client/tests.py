@@ -146,6 +146,18 @@ class TestReadWrite(CommonParts):
 
 		self.assertEqual(dataOrig, dataRead)
 
+	def test_iter_pdsd(self):
+		items = [ u'item \xe4 %d' % i for i in xrange(20000) ]
+		w = self.create(self.store1)
+		w.writeAll('PDSD', connector.dumpPDSD({'list' : items}))
+		w.commit()
+		rev = w.getRev()
+
+		with Connector().peek(self.store1, rev) as r:
+			dataRead = [ item for (i, item) in r.iterPDSD('PDSD', ['list']) ]
+
+		self.assertEqual(items, dataRead)
+
 	def test_mtime(self):
 		w = self.create(self.store1)
 		w.writeAll('FILE', "fubar")
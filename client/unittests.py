@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests of client internals. Unlike tests.py they do not need a running
+# server.
+
+import unittest, copy, struct, tempfile, shutil, os
+
+from peerdrive import connector, extractors, history
+from peerdrive import struct as pdstruct
+from peerdrive.registry import _Registry
+from views import diff3
+
+STORE = '\x01' * 16
+
+
+class TestPacketReader(unittest.TestCase):
+
+	def packet(self, ref, msg, payload):
+		return struct.pack('>HLH', len(payload) + 6, ref, msg) + payload
+
+	def test_split(self):
+		packets = [ (i, 0x51, 'x' * (i * 7 % 300)) for i in xrange(100) ]
+		stream = ''.join([ self.packet(*p) for p in packets ])
+		for size in [1, 3, 64, 1000, len(stream)]:
+			reader = connector._PacketReader()
+			result = []
+			for i in xrange(0, len(stream), size):
+				reader.feed(stream[i:i+size])
+				result.extend(reader.packets())
+			self.assertEqual(result, packets)
+			self.assertEqual(reader.pending(), 0)
+
+	def test_partial(self):
+		reader = connector._PacketReader()
+		raw = self.packet(1, 2, 'payload')
+		reader.feed(raw[:-1])
+		self.assertEqual(list(reader.packets()), [])
+		self.assertEqual(reader.pending(), len(raw) - 1)
+		reader.feed(raw[-1:])
+		self.assertEqual(list(reader.packets()), [ (1, 2, 'payload') ])
+
+	def test_feed_while_consuming(self):
+		reader = connector._PacketReader()
+		reader.feed(self.packet(1, 1, 'a'))
+		result = []
+		for packet in reader.packets():
+			result.append(packet)
+			if packet[0] == 1:
+				reader.feed(self.packet(2, 1, 'b'))
+		self.assertEqual(result, [ (1, 1, 'a'), (2, 1, 'b') ])
+
+	def test_compaction(self):
+		# the consumed head is moved at most once per buffer generation
+		reader = connector._PacketReader()
+		stream = self.packet(1, 1, 'x' * 100) * 1000
+		count = 0
+		for i in xrange(0, len(stream), 150):
+			reader.feed(stream[i:i+150])
+			count += len(list(reader.packets()))
+		self.assertEqual(count, 1000)
+		self.assertTrue(0 < reader.copied <= len(stream))
+
+
+class TestPDSD(unittest.TestCase):
+
+	def roundtrip(self, value):
+		return connector.loadPDSD(STORE, connector.dumpPDSD(value))
+
+	def test_scalars(self):
+		for value in [0, 1, 255, 256, 65535, 65536, 2**32, 2**63, -1, -128,
+		              -129, -32769, -2**31 - 1, -2**63, 1.5, -0.25, True,
+		              False, u'', u'\u20ac', 'abc']:
+			result = self.roundtrip([value])[0]
+			self.assertEqual(result, value)
+			self.assertEqual(type(result) is bool, type(value) is bool)
+
+	def test_nested(self):
+		value = { 'a' : [ { 'b' : [] }, { } ], u'\xe4' : { 'c' : [1, [2]] } }
+		self.assertEqual(self.roundtrip(value), value)
+
+	def test_links(self):
+		doc = connector.DocLink(STORE, '\x02' * 16, False)
+		rev = connector.RevLink(STORE, '\x03' * 16)
+		(doc2, rev2) = self.roundtrip([doc, rev])
+		self.assertEqual(doc2, doc)
+		self.assertEqual(doc2.store(), STORE)
+		self.assertEqual(rev2, rev)
+
+	def test_tuple(self):
+		self.assertEqual(self.roundtrip((1, 2)), [1, 2])
+
+	def test_invalid(self):
+		self.assertRaises(TypeError, connector.dumpPDSD, object())
+		self.assertRaises(TypeError, connector.dumpPDSD, { 1 : 2 })
+		self.assertRaises(TypeError, connector.loadPDSD, STORE, '\xff')
+
+
+class TestLazy(unittest.TestCase):
+
+	VALUE = {
+		'title' : u'folder',
+		'org.peerdrive.folder' : [ { '' : i, 'n' : [i] } for i in xrange(10) ],
+		'empty' : [ ],
+	}
+
+	def load(self):
+		return connector.loadPDSD(STORE, connector.dumpPDSD(self.VALUE), True)
+
+	def test_dict(self):
+		d = self.load()
+		self.assertTrue(isinstance(d, connector.LazyDict))
+		self.assertEqual(len(d), 3)
+		self.assertTrue('title' in d)
+		self.assertFalse('missing' in d)
+		self.assertEqual(sorted(d), sorted(self.VALUE))
+		self.assertEqual(d['title'], u'folder')
+		self.assertTrue(d['title'] is d['title'])
+		self.assertRaises(KeyError, lambda: d['missing'])
+		self.assertEqual(dict(d.items())['empty'], [])
+
+	def test_list(self):
+		l = self.load()['org.peerdrive.folder']
+		self.assertTrue(isinstance(l, connector.LazyList))
+		self.assertEqual(len(l), 10)
+		self.assertEqual(l[3]['n'], [3])
+		self.assertEqual(l[-1][''], 9)
+		self.assertEqual([ i[''] for i in l[2:5] ], [2, 3, 4])
+		self.assertRaises(IndexError, lambda: l[10])
+		self.assertEqual(l, l)
+		self.assertEqual(self.load()['empty'], [])
+		self.assertNotEqual(self.load()['empty'], [1])
+
+	def test_deepcopy(self):
+		d = copy.deepcopy(self.load())
+		self.assertEqual(type(d), dict)
+		self.assertEqual(type(d['org.peerdrive.folder']), list)
+		self.assertEqual(d, self.VALUE)
+
+	def test_encode(self):
+		# unchanged lazy values are written back as they were read
+		d = self.load()
+		self.assertEqual(connector.dumpPDSD({ 'x' : d['org.peerdrive.folder'] }),
+			connector.dumpPDSD({ 'x' : self.VALUE['org.peerdrive.folder'] }))
+		self.assertEqual(connector.loadPDSD(STORE, connector.dumpPDSD(d)),
+			self.VALUE)
+
+
+class TestStructMerge(unittest.TestCase):
+
+	def test_scalar(self):
+		self.assertEqual(pdstruct.merge(1, [1, 1]), (1, False))
+		self.assertEqual(pdstruct.merge(1, [2, 1]), (2, False))
+		self.assertEqual(pdstruct.merge(1, [2, 3]), (2, True))
+		self.assertEqual(pdstruct.merge(1, [u'a', 1]), (u'a', True))
+
+	def test_dict(self):
+		base = { 'a' : 1, 'b' : 2, 'c' : 3 }
+		(result, conflict) = pdstruct.merge(base, [
+			{ 'a' : 1, 'b' : 5, 'd' : 4 },
+			{ 'a' : 1, 'b' : 2, 'c' : 3, 'e' : 6 } ])
+		self.assertEqual(result, { 'a' : 1, 'b' : 5, 'd' : 4, 'e' : 6 })
+		self.assertFalse(conflict)
+
+	def test_dict_conflict(self):
+		(result, conflict) = pdstruct.merge({ 'a' : 1 }, [ { }, { 'a' : 2 } ])
+		self.assertEqual(result, { })
+		self.assertTrue(conflict)
+
+	def test_list(self):
+		base = [ { '' : 1 }, { '' : 2 }, [3], { '' : 2 } ]
+		(result, conflict) = pdstruct.merge(base, [
+			[ { '' : 1 }, { '' : 2 }, [3], { '' : 4 } ],
+			[ { '' : 2 }, [3], { '' : 2 }, { '' : 5 } ] ])
+		self.assertEqual(result, [ { '' : 2 }, [3], { '' : 2 }, { '' : 4 },
+			{ '' : 5 } ])
+		self.assertFalse(conflict)
+
+	def test_list_remove(self):
+		# only the first occurrence of a removed item is taken out
+		(result, conflict) = pdstruct.merge([1, 2, 1], [ [2], [1, 2, 1] ])
+		self.assertEqual(result, [2, 1])
+
+	def test_merge_key(self):
+		key = pdstruct._mergeKey
+		self.assertEqual(key({ 'a' : [1, { 'b' : 2 }] }),
+			key({ 'a' : [1, { 'b' : 2 }] }))
+		self.assertNotEqual(key([1, 2]), key((1, 2)))
+		self.assertNotEqual(key({ 'a' : 1 }), key({ 'a' : 2 }))
+		lazy = connector.loadPDSD(STORE, connector.dumpPDSD({ 'a' : [1] }), True)
+		self.assertEqual(key(lazy), key({ 'a' : [1] }))
+		hash(key({ 'a' : [ { } ] }))
+
+
+class TestDiff3(unittest.TestCase):
+
+	def lines(self, s):
+		return [ line + '\n' for line in s.split() ]
+
+	def checkMatch(self, a, b, expected=None):
+		m = diff3._match(a, b)
+		pairs = [ (i, j) for (i, j) in enumerate(m) if j >= 0 ]
+		for (i, j) in pairs:
+			self.assertEqual(a[i], b[j])
+		self.assertEqual([ j for (i, j) in pairs ], sorted(set(j for (i, j) in
+			pairs)))
+		if expected is not None:
+			self.assertEqual(len(pairs), expected)
+
+	def test_match(self):
+		self.checkMatch([1, 2, 3, 4], [1, 3, 4], 3)
+		self.checkMatch([1, 2, 3], [4, 5], 0)
+		self.checkMatch([], [1], 0)
+		# unique lines anchor the patience diff
+		self.checkMatch([1, 5, 2, 3, 4], [1, 2, 3, 5, 4], 4)
+
+	def test_myers(self):
+		# no unique lines left, only Myers can find the common subsequence
+		self.checkMatch([1, 2, 1, 2, 1, 2], [2, 1, 2, 1, 2, 1], 5)
+		self.checkMatch([1, 1, 2, 2, 1], [1, 2, 1, 2, 1], 4)
+
+	def test_myers_cost(self):
+		old = diff3.MAX_MYERS_COST
+		diff3.MAX_MYERS_COST = 2
+		try:
+			a = [1, 2] * 20
+			b = [2, 1] * 20
+			self.checkMatch(a, b)
+			self.assertEqual(diff3.text_merge('a\n', 'a\nb\n', 'a\n'),
+				'a\nb\n')
+		finally:
+			diff3.MAX_MYERS_COST = old
+
+	def test_clean(self):
+		old = 'a\nb\nc\nd\ne\n'
+		other = 'a\nB\nc\nd\ne\n'
+		new = 'a\nb\nc\nd\nE\nf\n'
+		self.assertEqual(diff3.text_merge(old, other, new),
+			'a\nB\nc\nd\nE\nf\n')
+
+	def test_same_change(self):
+		old = self.lines('a b c')
+		new = self.lines('a x c')
+		self.assertEqual(diff3.merge(old, new, new), new)
+
+	def test_conflict(self):
+		old = 'a\nb\nc\n'
+		other = 'a\nx\nc\n'
+		new = 'a\ny\nc\n'
+		self.assertEqual(diff3.text_merge(old, other, new, 1, '<\n', '=\n',
+			'>\n'), 'a\n<\nx\n=\ny\n>\nc\n')
+		self.assertEqual(diff3.text_merge(old, other, new, 0), None)
+
+	def test_empty(self):
+		self.assertEqual(diff3.text_merge('', 'a\n', ''), 'a\n')
+		self.assertEqual(diff3.text_merge('a\n', '', 'a\n'), '')
+
+
+class TestRegistry(unittest.TestCase):
+
+	REGISTRY = {
+		'public.item' : { 'display' : 'Item', 'exec' : ['item.py'] },
+		'public.data' : { 'conforming' : ['public.item'],
+			'extensions' : ['.bin'], 'exec' : ['data.py', 'item.py'] },
+		'public.text' : { 'conforming' : ['public.data'],
+			'extensions' : ['.txt'], 'mimetypes' : ['text/plain'],
+			'meta' : ['a'] },
+		'public.plain' : { 'conforming' : ['public.text', 'public.plain'],
+			'extensions' : ['.txt'], 'mimetypes' : ['text/plain'],
+			'meta' : ['b'] },
+	}
+
+	def setUp(self):
+		self.registry = _Registry.__new__(_Registry)
+		self.registry._setRegistry(self.REGISTRY)
+
+	def test_lookup(self):
+		r = self.registry
+		self.assertEqual(r.getUtiFromExtension('.bin'), 'public.data')
+		self.assertTrue(r.getUtiFromExtension('.txt') in ('public.text',
+			'public.plain'))
+		self.assertEqual(r.getUtiFromExtension('.xyz'), 'public.data')
+		self.assertEqual(r.getUtiFromExtension('.xyz', None), None)
+		self.assertEqual(r.getUtiFromMime('text/plain; charset=utf-8'),
+			r.getUtiFromExtension('.txt'))
+
+	def test_conformes(self):
+		r = self.registry
+		self.assertTrue(r.conformes('public.plain', 'public.item'))
+		self.assertTrue(r.conformes('public.plain', 'public.plain'))
+		self.assertTrue(r.conformes('unknown', 'unknown'))
+		self.assertFalse(r.conformes('public.data', 'public.text'))
+		self.assertFalse(r.conformes('unknown', 'public.item'))
+
+	def test_search(self):
+		r = self.registry
+		self.assertEqual(r.getDisplayString('public.plain'), 'Item')
+		self.assertEqual(r.search('public.plain', 'display', False), None)
+		self.assertEqual(r.getDisplayString('unknown'), 'unknown')
+		self.assertEqual(r.searchAll('public.plain', 'meta'),
+			{ 'public.text' : ['a'], 'public.plain' : ['b'] })
+		self.assertEqual(sorted(r.getMeta('public.plain')), ['a', 'b'])
+
+	def test_executables(self):
+		r = self.registry
+		self.assertEqual(r.getExecutables('public.text'), ['data.py', 'item.py'])
+		r.getExecutables('public.text').append('x')
+		self.assertEqual(r.getExecutables('public.text'), ['data.py', 'item.py'])
+
+	def test_reload(self):
+		r = self.registry
+		self.assertEqual(r.getExtractor('public.text'), None)
+		r._setRegistry({ 'public.text' : { 'extractor' : 'x:y' } })
+		self.assertEqual(r.getExtractor('public.text'), 'x:y')
+		self.assertFalse(r.conformes('public.text', 'public.item'))
+
+
+class TestImageSize(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def size(self, data):
+		path = os.path.join(self.dir, 'image')
+		with open(path, 'wb') as f:
+			f.write(data)
+		return extractors.imageSize(path)
+
+	def test_png(self):
+		data = '\x89PNG\r\n\x1a\n' + struct.pack('>L4sLL', 13, 'IHDR', 640,
+			480) + '\0' * 20
+		self.assertEqual(self.size(data), (640, 480))
+
+	def test_gif(self):
+		self.assertEqual(self.size('GIF89a' + struct.pack('<HH', 320, 200) +
+			'\0' * 20), (320, 200))
+
+	def test_bmp(self):
+		header = 'BM' + '\0' * 12
+		self.assertEqual(self.size(header + struct.pack('<Lll', 40, 100, -50) +
+			'\0' * 20), (100, 50))
+		self.assertEqual(self.size(header + struct.pack('<LHH', 12, 30, 20) +
+			'\0' * 20), (30, 20))
+
+	def test_jpeg(self):
+		app0 = '\xff\xe0' + struct.pack('>H', 16) + 'JFIF\0' + '\0' * 9
+		sof = '\xff\xc0' + struct.pack('>HBHHB', 11, 8, 768, 1024, 1) + '\0' * 3
+		self.assertEqual(self.size('\xff\xd8' + app0 + sof), (1024, 768))
+		self.assertEqual(self.size('\xff\xd8' + app0 + '\xff\xd9'), None)
+
+	def test_tiff(self):
+		for order in ['<', '>']:
+			magic = 'II*\0' if order == '<' else 'MM\0*'
+			ifd = struct.pack(order + 'H', 2)
+			ifd += struct.pack(order + 'HHLHH', 256, 3, 1, 1200, 0)
+			ifd += struct.pack(order + 'HHLL', 257, 4, 1, 900)
+			data = magic + struct.pack(order + 'L', 8) + ifd + '\0' * 20
+			self.assertEqual(self.size(data), (1200, 900))
+
+	def test_unknown(self):
+		self.assertEqual(self.size('no image at all, just text' * 2), None)
+		self.assertEqual(self.size('\x89PNG\r\n\x1a\n'), None)
+
+
+class TestHistoryLayout(unittest.TestCase):
+
+	def layout(self, graph):
+		# graph: [(rev, parents)] youngest first
+		lanes = []
+		return [ history._layoutRow(lanes, rev, parents) for (rev, parents)
+			in graph ]
+
+	def test_linear(self):
+		rows = self.layout([ ('c', ['b']), ('b', ['a']), ('a', []) ])
+		self.assertEqual(rows, [
+			(0, [], ['b']),
+			(0, ['b'], ['a']),
+			(0, ['a'], []) ])
+
+	def test_merge(self):
+		rows = self.layout([ ('m', ['a', 'b']), ('b', ['r']), ('a', ['r']),
+			('r', []) ])
+		self.assertEqual(rows, [
+			(0, [], ['a', 'b']),
+			(1, ['a', 'b'], ['a', 'r']),
+			(0, ['a', 'r'], [None, 'r']),
+			(1, [None, 'r'], []) ])
+
+	def test_two_heads(self):
+		rows = self.layout([ ('x', ['r']), ('y', ['r']), ('r', []) ])
+		self.assertEqual(rows, [
+			(0, [], ['r']),
+			(1, ['r'], ['r']),
+			(0, ['r'], []) ])
+
+
+class TestIncrementalDecoder(unittest.TestCase):
+
+	DATA = {
+		'title' : u'€ uro',
+		'list' : [ 1, -2, 3.5, u'h\xe4llo', { 'a' : [ 'b' ] }, True ],
+		'empty' : { },
+	}
+
+	def chunks(self, s, size):
+		return [ s[i:i+size] for i in xrange(0, len(s), size) ]
+
+	def test_whole(self):
+		s = connector.dumpPDSD(self.DATA)
+		self.assertEqual(dict(connector.iterPDSD(STORE, [s])), self.DATA)
+
+	def test_split_everywhere(self):
+		# every split position, including inside tokens and UTF-8 sequences
+		s = connector.dumpPDSD(self.DATA)
+		for i in xrange(len(s)):
+			result = dict(connector.iterPDSD(STORE, [s[:i], s[i:]]))
+			self.assertEqual(result, self.DATA)
+
+	def test_single_bytes(self):
+		s = connector.dumpPDSD(self.DATA)
+		result = dict(connector.iterPDSD(STORE, self.chunks(s, 1)))
+		self.assertEqual(result, self.DATA)
+
+	def test_list_items(self):
+		s = connector.dumpPDSD(self.DATA['list'])
+		result = list(connector.iterPDSD(STORE, self.chunks(s, 3)))
+		self.assertEqual(result, list(enumerate(self.DATA['list'])))
+
+	def test_path(self):
+		s = connector.dumpPDSD(self.DATA)
+		result = list(connector.iterPDSD(STORE, self.chunks(s, 2), ['list', 4]))
+		self.assertEqual(result, [ ('a', ['b']) ])
+
+	def test_missing_path(self):
+		s = connector.dumpPDSD(self.DATA)
+		self.assertRaises(KeyError, list,
+			connector.iterPDSD(STORE, [s], ['missing']))
+
+	def test_truncated(self):
+		s = connector.dumpPDSD(self.DATA)
+		self.assertRaises(TypeError, list,
+			connector.iterPDSD(STORE, self.chunks(s[:-1], 4)))
+
+	def test_invalid_utf8(self):
+		s = connector.dumpPDSD([u'\xe4x'])
+		s = s.replace('\xc3\xa4', '\xc3\x28')
+		self.assertRaises(UnicodeDecodeError, list,
+			connector.iterPDSD(STORE, self.chunks(s, 1)))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,197 +1,225 @@
-# -*- coding: iso-8859-1 -*-
-"""
-    MoinMoin - diff3 algorithm
+# vim: set fileencoding=utf-8 :
+#
+# PeerDrive
+# Copyright (C) 2011  Jan Klötzke <jan DOT kloetzke AT freenet DOT de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Line based three way merge.
 
-    @copyright: 2002 by Florian Festi
-    @license: GNU GPL, see COPYING for details.
+Both versions are diffed against the common ancestor with a patience diff
+which falls back to Myers' algorithm where no unique lines are left. The
+two diffs are then walked in parallel like diff3 does: regions where only
+one side changed are merged cleanly, overlapping changes are conflicts.
 """
 
+import bisect
+
+# Upper bound of the edit distance the Myers fallback is allowed to search.
+# Regions which differ even more are treated as replaced completely.
+MAX_MYERS_COST = 1000
+
+
 def text_merge(old, other, new, allow_conflicts=1,
-               marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
-               marker2='=========================\n',
-               marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
-    """ do line by line diff3 merge with three strings"""
-    result = merge(old.splitlines(1), other.splitlines(1), new.splitlines(1),
-                   allow_conflicts, marker1, marker2, marker3)
-    return ''.join(result)
+	marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
+	marker2='=========================\n',
+	marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
+	"""Do a line by line diff3 merge of three strings.
+
+	Returns None if there are conflicts and allow_conflicts is false.
+	"""
+	result = merge(old.splitlines(1), other.splitlines(1), new.splitlines(1),
+		allow_conflicts, marker1, marker2, marker3)
+	if result is None:
+		return None
+	return ''.join(result)
+
 
 def merge(old, other, new, allow_conflicts=1,
-          marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
-          marker2='=========================\n',
-          marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
-    """ do line by line diff3 merge
-        input must be lists containing single lines
-    """
-    old_nr, other_nr, new_nr = 0, 0, 0
-    old_len, other_len, new_len = len(old), len(other), len(new)
-    result = []
-    while old_nr < old_len and other_nr < other_len  and new_nr < new_len:
-        # unchanged
-        if old[old_nr] == other[other_nr] == new[new_nr]:
-            result.append(old[old_nr])
-            old_nr += 1
-            other_nr += 1
-            new_nr += 1
-        else:
-            new_match = find_match(old, new, old_nr, new_nr)
-            other_match = find_match(old, other, old_nr, other_nr)
-            # new is changed
-            if new_match != (old_nr, new_nr):
-                new_changed_lines = new_match[0] - old_nr
-                # other is unchanged
-                if match(old, other, old_nr, other_nr,
-                         new_changed_lines) == new_changed_lines:
-                    result.extend(new[new_nr:new_match[1]])
-                    old_nr = new_match[0]
-                    new_nr = new_match[1]
-                    other_nr += new_changed_lines
-                # both changed, conflict!
-                else:
-                    if not allow_conflicts: return None
-                    old_m, other_m, new_m = tripple_match(
-                        old, other, new, other_match, new_match)
-                    result.append(marker1)
-                    result.extend(other[other_nr:other_m])
-                    result.append(marker2)
-                    result.extend(new[new_nr:new_m])
-                    result.append(marker3)
-                    old_nr, other_nr, new_nr = old_m, other_m, new_m
-            # other is changed
-            else:
-                other_changed_lines = other_match[0] - other_nr
-                # new is unchanged
-                if match(old, new, old_nr, new_nr,
-                         other_changed_lines) == other_changed_lines:
-                    result.extend(other[other_nr:other_match[1]])
-                    old_nr = other_match[0]
-                    other_nr = other_match[1]
-                    new_nr += other_changed_lines
-                # both changed, conflict!
-                else:
-                    if not allow_conflicts: return None
-                    old_m, other_m, new_m = tripple_match(
-                        old, other, new, other_match, new_match)
-                    result.append(marker1)
-                    result.extend(other[other_nr:other_m])
-                    result.append(marker2)
-                    result.extend(new[new_nr:new_m])
-                    result.append(marker3)
-                    old_nr, other_nr, new_nr = old_m, other_m, new_m
-
-    # process tail
-    # all finished
-    if old_nr==old_len and other_nr==other_len  and new_nr==new_len:
-        pass
-    # new added lines
-    elif old_nr==old_len and other_nr==other_len:
-        result.extend(new[new_nr:])
-    # other added lines
-    elif old_nr==old_len and new_nr==new_len:
-        result.extend(other[other_nr])
-    # new deleted lines
-    elif (new_nr==new_len and (old_len-old_nr==other_len-other_nr) and
-          match(old, other, old_nr, other_nr, old_len-old_nr) ==
-          old_len-old_nr):
-        pass
-    # other deleted lines
-    elif (other_nr==other_len and (old_len-old_nr==new_len-new_nr) and
-          match(old, new, old_nr, new_nr, old_len-old_nr) ==
-          old_len-old_nr):
-        pass
-    # conflict
-    else:
-        if not allow_conflicts: return None
-        result.append(marker1)
-        result.extend(other[other_nr:])
-        result.append(marker2)
-        result.extend(new[new_nr:])
-        result.append(marker3)
-    return result
-
-def tripple_match(old, other, new, other_match, new_match):
-    """find next matching pattern unchanged in both other and new
-       return the position in all three lists
-    """
-    while 1:
-        difference = new_match[0]-other_match[0]
-        # new changed more lines
-        if difference > 0:
-            match_len = match(old, other, other_match[0], other_match[1],
-                              difference)
-            if match_len == difference:
-                return (new_match[0], other_match[1]+difference, new_match[1])
-            else:
-                other_match =  find_match(old, other,
-                                          other_match[0] + match_len,
-                                          other_match[1] + match_len)
-        # other changed more lines
-        elif difference < 0:
-            difference = -difference
-            match_len = match(old, new, new_match[0], new_match[1],
-                              difference)
-            if match_len == difference:
-                return (other_match[0], other_match[1],
-                        new_match[0]+difference)
-            else:
-                new_match =  find_match(old, new,
-                                        new_match[0] + match_len,
-                                        new_match[1] + match_len)
-        # both conflicts change same number of lines
-        # or no match till the end
-        else:
-            return (new_match[0], other_match[1], new_match[1])
-
-def match(list1, list2, nr1, nr2, maxcount=3):
-    """ return the number matching items after the given positions
-        maximum maxcount lines are are processed
-    """
-    i = 0
-    len1 = len(list1)
-    len2 = len(list2)
-    while nr1 < len1 and nr2 < len2 and list1[nr1] == list2[nr2]:
-        nr1 += 1
-        nr2 += 1
-        i += 1
-        if i >= maxcount and maxcount>0: break
-    return i
-
-def find_match(list1, list2, nr1, nr2, mincount=3):
-    """searches next matching pattern with lenght mincount
-       if no pattern is found len of the both lists is returned
-    """
-    len1 = len(list1)
-    len2 = len(list2)
-    hit1 = None
-    hit2 = None
-    idx1 = nr1
-    idx2 = nr2
-
-    while ((idx1 < len1) or (idx2 < len2)):
-        i =  nr1
-        while i <= idx1:
-            hit_count = match(list1, list2, i, idx2, mincount)
-            if hit_count >= mincount:
-                hit1 = (i, idx2)
-                break
-            i = i + 1
-
-        i = nr2
-        while i < idx2:
-            hit_count = match(list1, list2, idx1, i, mincount)
-            if hit_count >= mincount:
-                hit2 = (idx1, i)
-                break
-            i = i + 1
-
-        if hit1 or hit2: break
-        if idx1 < len1: idx1 = idx1 + 1
-        if idx2 < len2: idx2 = idx2 + 1
-
-    if hit1 and hit2:
-        #XXXX which one?
-        return hit1
-    elif hit1: return hit1
-    elif hit2: return hit2
-    else: return (len1, len2)
+	marker1='<<<<<<<<<<<<<<<<<<<<<<<<<\n',
+	marker2='=========================\n',
+	marker3='>>>>>>>>>>>>>>>>>>>>>>>>>\n'):
+	"""Do a line by line diff3 merge of three lists of lines."""
+	(oldIds, otherIds, newIds) = _lineIds(old, other, new)
+	toOther = _match(oldIds, otherIds)
+	toNew = _match(oldIds, newIds)
+
+	result = []
+	oldLen = len(old)
+	o = a = b = 0
+	while True:
+		# stable chunk: lines kept in place by both sides
+		start = o
+		while o < oldLen and toOther[o] == a and toNew[o] == b:
+			o += 1
+			a += 1
+			b += 1
+		result.extend(old[start:o])
+
+		# unstable chunk up to the next line which is kept by both sides
+		j = o
+		while j < oldLen and (toOther[j] < 0 or toNew[j] < 0):
+			j += 1
+		if j < oldLen:
+			(k, l) = (toOther[j], toNew[j])
+		else:
+			(k, l) = (len(other), len(new))
+		if j == o and k == a and l == b:
+			break
+
+		oldChunk = oldIds[o:j]
+		otherChunk = otherIds[a:k]
+		newChunk = newIds[b:l]
+		if otherChunk == oldChunk:
+			result.extend(new[b:l])
+		elif newChunk == oldChunk or newChunk == otherChunk:
+			result.extend(other[a:k])
+		elif allow_conflicts:
+			result.append(marker1)
+			result.extend(other[a:k])
+			result.append(marker2)
+			result.extend(new[b:l])
+			result.append(marker3)
+		else:
+			return None
+		(o, a, b) = (j, k, l)
+
+	return result
+
+
+def _lineIds(*texts):
+	# replace lines by small integers so that comparisons are cheap
+	ids = {}
+	return [ [ ids.setdefault(line, len(ids)) for line in text ]
+		for text in texts ]
+
+
+def _match(a, b):
+	"""Return a list which maps each index of 'a' to the matching index in
+	'b' or to -1 if the line was removed."""
+	result = [-1] * len(a)
+	regions = [(0, len(a), 0, len(b))]
+	while regions:
+		(alo, ahi, blo, bhi) = regions.pop()
+		while alo < ahi and blo < bhi and a[alo] == b[blo]:
+			result[alo] = blo
+			alo += 1
+			blo += 1
+		while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+			ahi -= 1
+			bhi -= 1
+			result[ahi] = bhi
+		if alo == ahi or blo == bhi:
+			continue
+
+		anchors = _patience(a, b, alo, ahi, blo, bhi)
+		if anchors:
+			for (i, j) in anchors:
+				result[i] = j
+				regions.append((alo, i, blo, j))
+				(alo, blo) = (i+1, j+1)
+			regions.append((alo, ahi, blo, bhi))
+		else:
+			for (i, j) in _myers(a, b, alo, ahi, blo, bhi):
+				result[i] = j
+
+	return result
+
+
+def _patience(a, b, alo, ahi, blo, bhi):
+	# longest increasing sequence of lines which are unique on both sides
+	aUnique = {}
+	for i in xrange(alo, ahi):
+		line = a[i]
+		aUnique[line] = -1 if line in aUnique else i
+	bUnique = {}
+	for j in xrange(blo, bhi):
+		line = b[j]
+		bUnique[line] = -1 if line in bUnique else j
+
+	pairs = []
+	back = []
+	tops = []
+	piles = []
+	for i in xrange(alo, ahi):
+		line = a[i]
+		if aUnique[line] != i:
+			continue
+		j = bUnique.get(line, -1)
+		if j < 0:
+			continue
+		pile = bisect.bisect_left(tops, j)
+		back.append(piles[pile-1] if pile else -1)
+		pairs.append((i, j))
+		if pile == len(tops):
+			tops.append(j)
+			piles.append(len(pairs)-1)
+		else:
+			tops[pile] = j
+			piles[pile] = len(pairs)-1
+
+	result = []
+	k = piles[-1] if piles else -1
+	while k >= 0:
+		result.append(pairs[k])
+		k = back[k]
+	result.reverse()
+	return result
+
+
+def _myers(a, b, alo, ahi, blo, bhi):
+	# greedy O(ND) shortest edit script, returns the matched index pairs
+	n = ahi - alo
+	m = bhi - blo
+	v = { 1 : 0 }
+	trace = []
+	for d in xrange(min(n + m, MAX_MYERS_COST) + 1):
+		trace.append(v.copy())
+		for k in xrange(-d, d+1, 2):
+			if k == -d or (k != d and v[k-1] < v[k+1]):
+				x = v[k+1]
+			else:
+				x = v[k-1] + 1
+			y = x - k
+			while x < n and y < m and a[alo+x] == b[blo+y]:
+				x += 1
+				y += 1
+			v[k] = x
+			if x >= n and y >= m:
+				return _myersMatches(trace, n, m, alo, blo)
+	return []
 
 
+def _myersMatches(trace, x, y, alo, blo):
+	matches = []
+	for d in xrange(len(trace)-1, 0, -1):
+		v = trace[d]
+		k = x - y
+		if k == -d or (k != d and v[k-1] < v[k+1]):
+			prevK = k + 1
+		else:
+			prevK = k - 1
+		prevX = v[prevK]
+		prevY = prevX - prevK
+		while x > prevX and y > prevY:
+			x -= 1
+			y -= 1
+			matches.append((alo+x, blo+y))
+		(x, y) = (prevX, prevY)
+	while x > 0 and y > 0:
+		x -= 1
+		y -= 1
+		matches.append((alo+x, blo+y))
+	matches.reverse()
+	return matches
@@ -17,7 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, os.path, copy
+import os, os.path, copy, collections
 from PyQt4 import QtCore, QtGui
 from datetime import datetime
 import struct as pystruct
@@ -133,8 +133,8 @@ class MetaColumnInfo(object):
 
 	@staticmethod
 	def __convertList(item):
-		if isinstance(item, list):
-			if item == []:
+		if isinstance(item, (list, connector.LazyList)):
+			if len(item) == 0:
 				return ""
 			else:
 				return reduce(lambda x,y: unicode(x) + u', ' + unicode(y), item)
@@ -217,6 +217,17 @@ def _columnFactory(key):
 	return None
 
 
+def _collect(futures):
+	# resolve a dict of futures, dropping failed requests
+	result = { }
+	for (key, future) in futures.items():
+		try:
+			result[key] = future.result()
+		except IOError:
+			pass
+	return result
+
+
 class FolderEntry(Watch):
 	def __init__(self, item, model, columns):
 		self.__model = model
@@ -229,21 +240,28 @@ class FolderEntry(Watch):
 		self.__columnValues = [ column.default() for column in columns ]
 		self.__columnDefs = columns[:]
 		self.__metaData = None
+		self.__stat = None
+		self.__rev = None
+		self.__needMerge = False
+		self.__isReplicated = False
+		self.__loaded = False
 
-		link = self.__item[''].update(self.__model.getStore())
+		link = self.__item['']
 		self.__store = model.getStore()
 		self.__doc = link.doc()
 
 		if isinstance(link, connector.DocLink):
 			super(FolderEntry, self).__init__(Watch.TYPE_DOC, link.doc())
 		else:
+			link.update(self.__store)
 			super(FolderEntry, self).__init__(Watch.TYPE_REV, link.rev())
 
-		self.update(False)
-
 	def isValid(self):
 		return self.__valid
 
+	def isLoaded(self):
+		return self.__loaded
+
 	def isFolder(self):
 		return self.__isFolder
 
@@ -312,82 +330,136 @@ class FolderEntry(Watch):
 	def getTypeCode(self):
 		return self.__uti
 
-	def update(self, updateItem = True):
-		# reset everything
+	def update(self):
+		FolderEntry.updateAll([self])
+
+	@staticmethod
+	def updateAll(entries):
+		"""Update a list of entries with as few round trips as possible.
+
+		Every document and revision is requested only once, no matter how many
+		entries refer to it, and all requests of a step are sent back to back.
+		"""
+		c = Connector()
+
+		# lookup all documents
+		lookups = {}
+		for entry in entries:
+			entry.__reset()
+			if entry.__doc and (entry.__doc not in lookups):
+				lookups[entry.__doc] = c.lookupDoc(entry.__doc, pipelined=True)
+		lookups = _collect(lookups)
+
+		# stat and open all revisions
+		stats = {}
+		handles = {}
+		for entry in entries:
+			rev = entry.__resolve(lookups.get(entry.__doc))
+			if rev and (rev not in stats):
+				try:
+					stats[rev] = c.stat(rev, pipelined=True)
+					handles[rev] = c.peek(entry.__store, rev, pipelined=True)
+				except IOError:
+					pass
+		stats = _collect(stats)
+		handles = _collect(handles)
+
+		# read annotations
+		metaData = {}
+		for (rev, handle) in handles.items():
+			metaData[rev] = handle.getData("/org.peerdrive.annotation",
+				pipelined=True, lazy=True)
+		closes = [ handle.close(pipelined=True) for handle in handles.values() ]
+		for (rev, data) in metaData.items():
+			try:
+				metaData[rev] = data.result()
+			except IOError:
+				metaData[rev] = { }
+		_collect(dict(enumerate(closes)))
+
+		# fill every entry from the results
+		icons = { }
+		for entry in entries:
+			entry.__loaded = True
+			if entry.__rev in stats:
+				entry.__fill(stats[entry.__rev], metaData.get(entry.__rev), icons)
+
+	def __reset(self):
 		self.__valid = False
 		self.__icon = None
+		self.__stat = None
+		self.__metaData = None
+		self.__needMerge = False
+		self.__isReplicated = False
 		for i in xrange(len(self.__columnDefs)):
 			column = self.__columnDefs[i]
 			if column.derived():
 				self.__columnValues[i] = column.default()
 
+	def __resolve(self, lookup):
 		# determine revision
-		needMerge = False
-		isReplicated = False
 		if self.__doc:
-			l = Connector().lookupDoc(self.__doc)
-			isReplicated = len(l.stores()) > 1
-			revisions = l.revs()
+			if lookup is None:
+				return None
+			self.__isReplicated = len(lookup.stores()) > 1
+			revisions = lookup.revs()
 			if len(revisions) == 0:
-				return
+				return None
 			elif len(revisions) > 1:
-				needMerge = True
-			if updateItem:
-				self.__item[''].update()
+				self.__needMerge = True
+			self.__item[''].update(self.__store, lookup)
 
 		self.__rev = self.__item[''].rev()
+		return self.__rev
+
+	def __fill(self, stat, metaData, icons):
+		self.__uti = stat.type()
+		if self.__needMerge:
+			emblem = "icons/emblems/split.png"
+		elif self.__isReplicated:
+			emblem = "icons/emblems/distributed.png"
+		else:
+			emblem = None
+		key = (self.__uti, emblem)
+		if key not in icons:
+			icons[key] = FolderEntry.__makeIcon(self.__uti, emblem)
+		self.__icon = icons[key]
 
-		# stat
-		try:
-			s = Connector().stat(self.__rev)
-		except IOError:
-			return
-		self.__uti = s.type()
-		if needMerge or isReplicated:
-			image = QtGui.QImage(Registry().getIcon(s.type()))
+		self.__isFolder = Registry().conformes(self.__uti, "org.peerdrive.folder")
+		self.__replacable = not self.__needMerge and not self.__isFolder
+		self.__valid = True
+		self.__stat = stat
+		self.__metaData = metaData
+		self.__updateColumns()
+
+	@staticmethod
+	def __makeIcon(uti, emblem):
+		if emblem:
+			image = QtGui.QImage(Registry().getIcon(uti))
 			painter = QtGui.QPainter()
 			painter.begin(image)
-			if needMerge:
-				painter.drawImage(0, 16, QtGui.QImage("icons/emblems/split.png"))
-			elif isReplicated:
-				painter.drawImage(0, 16, QtGui.QImage("icons/emblems/distributed.png"))
+			painter.drawImage(0, 16, QtGui.QImage(emblem))
 			painter.end()
-			self.__icon = QtGui.QIcon(QtGui.QPixmap.fromImage(image))
+			return QtGui.QIcon(QtGui.QPixmap.fromImage(image))
 		else:
-			self.__icon = QtGui.QIcon(Registry().getIcon(s.type()))
-
-		self.__isFolder = Registry().conformes(self.__uti, "org.peerdrive.folder")
-		self.__replacable = not needMerge and not self.__isFolder
-		self.__valid = True
-		self.__updateColumns(s)
+			return QtGui.QIcon(Registry().getIcon(uti))
 
-	def __updateColumns(self, stat = None):
+	def __updateColumns(self):
 		# This makes only sense if we're a valid entry
 		if not self.__valid:
 			return
 
-		try:
-			if stat is None:
-				stat = Connector().stat(self.__rev)
-			with Connector().peek(self.__store, self.__rev) as r:
-				try:
-					metaData = r.getData("/org.peerdrive.annotation")
-				except:
-					metaData = { }
-
-			for i in xrange(len(self.__columnDefs)):
-				column = self.__columnDefs[i]
-				if column.derived():
-					self.__columnValues[i] = column.extract(stat, metaData)
-
-			self.__metaData = metaData
-
-		except IOError:
-			self.__metaData = None
-			for i in xrange(len(self.__columnDefs)):
-				column = self.__columnDefs[i]
-				if column.derived():
-					self.__columnValues[i] = column.default()
+		# The revision is immutable. Re-use what was fetched by updateAll().
+		stat = self.__stat
+		metaData = self.__metaData
+		for i in xrange(len(self.__columnDefs)):
+			column = self.__columnDefs[i]
+			if not column.derived():
+				pass
+			elif metaData is None:
+				self.__columnValues[i] = column.default()
+			else:
+				self.__columnValues[i] = column.extract(stat, metaData)
 
 	# callback when watch was triggered
 	def triggered(self, cause, store):
@@ -407,6 +479,12 @@ class FolderModel(QtCore.QAbstractTableModel):
 	AUTOCLEAN = ["org.peerdrive.folder", "autoclean"]
 	UTIs = ["org.peerdrive.folder", "org.peerdrive.store"]
 
+	# Entries are loaded in the background in batches of LOAD_BATCH.
+	# Entries which are requested by a view are loaded first, together with
+	# PREFETCH entries before and after them.
+	LOAD_BATCH = 64
+	PREFETCH = 32
+
 	def __init__(self, parent = None):
 		super(FolderModel, self).__init__(parent)
 		self.__parent = parent
@@ -418,6 +496,12 @@ class FolderModel(QtCore.QAbstractTableModel):
 		self.__autoClean = False
 		self.__mutable = False
 		self.__store = None
+		self.__pending = set() # entries which are not loaded yet
+		self.__queue = collections.deque() # load order of pending entries
+		self.__wanted = [] # entries requested by a view, most recent last
+		self.__requested = set() # entries in __wanted
+		self.__loading = False
+		self.__placeholder = QtGui.QIcon("icons/uti/unknown.png")
 		self.setColumns(["public.item:title"])
 
 	def doLoad(self, handle, readWrite, autoClean):
@@ -426,17 +510,87 @@ class FolderModel(QtCore.QAbstractTableModel):
 		self.__autoClean = autoClean
 		self.__typeCodes = set()
 		self.__store = handle.getStore()
-		self._listing = []
 		data = handle.getData('/org.peerdrive.folder')
-		listing = [ FolderEntry(item, self, self._columns) for item in data ]
-		for entry in listing:
+		self._listing = [ FolderEntry(item, self, self._columns) for item in data ]
+		self.__pending = set(self._listing)
+		self.__queue = collections.deque(self._listing)
+		self.__wanted = []
+		self.__requested = set()
+		self.reset()
+		self.__scheduleLoad()
+
+	def __want(self, row):
+		entry = self._listing[row]
+		if (entry in self.__pending) and (entry not in self.__requested):
+			first = max(row - FolderModel.PREFETCH, 0)
+			last = min(row + FolderModel.PREFETCH, len(self._listing) - 1)
+			margin = [e for e in self._listing[first:last+1] if (e in self.__pending)
+				and (e not in self.__requested) and (e is not entry)]
+			self.__wanted.extend(margin)
+			self.__wanted.append(entry)
+			self.__requested.update(margin)
+			self.__requested.add(entry)
+			self.__scheduleLoad()
+
+	def __scheduleLoad(self):
+		if self.__pending and not self.__loading:
+			self.__loading = True
+			QtCore.QTimer.singleShot(0, self.__loadPending)
+
+	def __loadPending(self):
+		self.__loading = False
+		batch = []
+		while self.__wanted and (len(batch) < FolderModel.LOAD_BATCH):
+			entry = self.__wanted.pop()
+			self.__requested.discard(entry)
+			if entry in self.__pending:
+				self.__pending.remove(entry)
+				batch.append(entry)
+		while self.__queue and (len(batch) < FolderModel.LOAD_BATCH):
+			entry = self.__queue.popleft()
+			if entry in self.__pending:
+				self.__pending.remove(entry)
+				batch.append(entry)
+		if not batch:
+			return
+
+		FolderEntry.updateAll(batch)
+		rows = dict([ (entry, row) for (row, entry) in enumerate(self._listing) ])
+		watches = []
+		changed = []
+		removed = []
+		for entry in batch:
+			# Entries removed from the listing were released and thus are not
+			# pending anymore, so every entry of the batch has a row.
 			if entry.isValid() or (not self.__autoClean):
 				self.__typeCodes.add(entry.getTypeCode())
-				self._listing.append(entry)
-				Connector().watch(entry)
+				watches.append(Connector().watch(entry, pipelined=True))
+				changed.append(rows[entry])
 			else:
-				self.__changedContent = True
-		self.reset()
+				removed.append(rows[entry])
+		for watch in watches:
+			if watch:
+				watch.result()
+		if changed:
+			# A single notification for the whole batch, so that the sort
+			# proxy sorts only once.
+			leftIdx  = self.index(min(changed), 0)
+			rightIdx = self.index(max(changed), self.columnCount(None)-1)
+			self.emit(QtCore.SIGNAL("dataChanged(const QModelIndex&,const QModelIndex&)"), leftIdx, rightIdx)
+		if removed:
+			self.__changedContent = True
+			for row in sorted(removed, reverse=True):
+				self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+				del self._listing[row]
+				self.endRemoveRows()
+
+		self.__scheduleLoad()
+
+	def __release(self, entry):
+		if entry in self.__pending:
+			self.__pending.remove(entry)
+		elif entry.isLoaded():
+			Connector().unwatch(entry)
 
 	def doSave(self, handle):
 		data = [ item.getItem() for item in self._listing ]
@@ -445,8 +599,11 @@ class FolderModel(QtCore.QAbstractTableModel):
 
 	def clear(self):
 		for item in self._listing:
-			Connector().unwatch(item)
+			self.__release(item)
 		self._listing = []
+		self.__queue.clear()
+		self.__wanted = []
+		self.__requested = set()
 		del self.__parent
 
 	def hasChanged(self):
@@ -477,12 +634,12 @@ class FolderModel(QtCore.QAbstractTableModel):
 	def setAutoClean(self, autoClean):
 		self.__autoClean = autoClean
 		if autoClean and self.__mutable:
-			removed = [x for x in self._listing if not x.isValid()]
-			self._listing = [x for x in self._listing if x.isValid()]
+			removed = set(x for x in self._listing if x.isLoaded() and not x.isValid())
+			self._listing = [x for x in self._listing if x not in removed]
 			if len(removed) > 0:
 				self.__changedContent = True
 				for item in removed:
-					Connector().unwatch(item)
+					self.__release(item)
 				self.reset()
 
 	def getColumns(self):
@@ -540,10 +697,19 @@ class FolderModel(QtCore.QAbstractTableModel):
 		if index.column() >= self.columnCount(None):
 			return QtCore.QVariant()
 
+		entry = self._listing[index.row()]
+		if not entry.isLoaded():
+			# show a placeholder until the entry is loaded in the background
+			self.__want(index.row())
+			if (role == QtCore.Qt.DecorationRole) and (index.column() == 0):
+				return QtCore.QVariant(self.__placeholder)
+			else:
+				return QtCore.QVariant()
+
 		if (role == QtCore.Qt.DisplayRole) or (role == QtCore.Qt.EditRole):
-			return QtCore.QVariant(self._listing[index.row()].getColumnData(index.column()))
+			return QtCore.QVariant(entry.getColumnData(index.column()))
 		elif (role == QtCore.Qt.DecorationRole) and (index.column() == 0):
-			return QtCore.QVariant(self._listing[index.row()].getIcon())
+			return QtCore.QVariant(entry.getIcon())
 		#elif (role == QtCore.Qt.ForegroundRole):
 		#	return QtCore.QVariant(QtGui.QColor(QtCore.Qt.red))
 		else:
@@ -584,7 +750,7 @@ class FolderModel(QtCore.QAbstractTableModel):
 		self.__changedContent = True
 		self.beginRemoveRows(QtCore.QModelIndex(), position, position+rows-1)
 		for i in range(rows):
-			Connector().unwatch(self._listing[position])
+			self.__release(self._listing[position])
 			del self._listing[position]
 		self.endRemoveRows()
 		return True
@@ -712,11 +878,13 @@ class FolderModel(QtCore.QAbstractTableModel):
 		progress.setWindowModality(QtCore.Qt.WindowModal)
 		progress.setMinimumDuration(500)
 
+		errors = []
 		try:
 			helper = makeProgressHelper(progress)
 			for url in urlList:
 				path = str(url.toLocalFile().toUtf8())
-				handle = importer.importFile(self.__store, path, progress=helper)
+				handle = importer.importFile(self.__store, path, progress=helper,
+					errors=errors)
 				if handle:
 					try:
 						self.insertLink(connector.DocLink(self.__store, handle.getDoc()))
@@ -728,6 +896,11 @@ class FolderModel(QtCore.QAbstractTableModel):
 		finally:
 			progress.setValue(numFiles)
 
+		if errors:
+			QtGui.QMessageBox.warning(self.__parent, 'Import failed',
+				'The following files could not be imported:\n\n' +
+				'\n'.join([ "%s: %s" % (path, e) for (path, e) in errors ]))
+
 		return True
 
 	def __dropLinks(self, links):
@@ -795,6 +968,7 @@ class FolderModel(QtCore.QAbstractTableModel):
 
 	def insertLink(self, link):
 		entry = FolderEntry({'' : link}, self, self._columns)
+		entry.update()
 		self.__typeCodes.add(entry.getTypeCode())
 
 		# append new item
@@ -818,8 +992,9 @@ class FolderModel(QtCore.QAbstractTableModel):
 
 	# === Callbacks from a FolderEntry which has changed ===
 
-	def entryChanged(self, entry):
-		i = self._listing.index(entry)
+	def entryChanged(self, entry, i=None):
+		if i is None:
+			i = self._listing.index(entry)
 		leftIdx  = self.index(i, 0)
 		rightIdx = self.index(i, self.columnCount(None)-1)
 		self.emit(QtCore.SIGNAL("dataChanged(const QModelIndex&,const QModelIndex&)"), leftIdx, rightIdx)
@@ -947,23 +1122,6 @@ class FolderWidget(widgets.DocumentView):
 		if self.model().hasChanged():
 			self.model().doSave(handle)
 
-	def docMergeCheck(self, heads, types, changedParts):
-		(uti, handled) = super(FolderWidget, self).docMergeCheck(heads, types, changedParts)
-		return (uti, handled | set(['PDSD']))
-
-	def docMergePerform(self, writer, baseReader, mergeReaders, changedParts):
-		conflicts = super(FolderWidget, self).docMergePerform(writer, baseReader, mergeReaders, changedParts)
-		if 'PDSD' in changedParts:
-			basePdsd = struct.loads(self.store(), baseReader.readAll('PDSD'))
-			mergePdsd = []
-			for r in mergeReaders:
-				mergePdsd.append(struct.loads(self.store(), r.readAll('PDSD')))
-			(newPdsd, newConflict) = struct.merge(basePdsd, mergePdsd)
-			conflicts = conflicts or newConflict
-			writer.writeAll('PDSD', struct.dumps(newPdsd))
-
-		return conflicts
-
 	def model(self):
 		return self.__folderModel
 
@@ -72,26 +72,26 @@ class TextEdit(widgets.DocumentView):
 	def docMergeCheck(self, heads, types, changedParts):
 		(uti, handled) = super(TextEdit, self).docMergeCheck(heads, types, changedParts)
 		if heads == 2:
-			return (uti, handled | set(['FILE']))
+			return (uti, handled | set(['_']))
 		else:
 			return (uti, handled)
 
 	def docMergePerform(self, writer, baseReader, mergeReaders, changedParts):
 		conflicts = super(TextEdit, self).docMergePerform(writer, baseReader, mergeReaders, changedParts)
-		if 'FILE' in changedParts:
-			baseFile = baseReader.readAll('FILE')
-			rev1File = mergeReaders[0].readAll('FILE')
-			rev2File = mergeReaders[1].readAll('FILE')
+		if '_' in changedParts:
+			baseFile = baseReader.readAll('_')
+			rev1File = mergeReaders[0].readAll('_')
+			rev2File = mergeReaders[1].readAll('_')
 			if rev1File == baseFile:
 				newFile = rev2File
 			elif rev2File == baseFile:
 				newFile = rev1File
 			else:
-				newFile = diff3.text_merge(baseFile, rev1File, rev2File)
-				# the diff3 module is broken, basically there's never a clean
-				# merge
-				conflicts = True
-			writer.writeAll('FILE', newFile)
+				newFile = diff3.text_merge(baseFile, rev1File, rev2File, False)
+				if newFile is None:
+					newFile = diff3.text_merge(baseFile, rev1File, rev2File)
+					conflicts = True
+			writer.writeAll('_', newFile)
 
 		return conflicts
 